@@ -0,0 +1,371 @@
+""" Azulejo benchmark harness
+
+    Synthetic tile libraries and sources are generated (once, deterministically)
+    in a work directory, then each benchmark case (library size, source size,
+    tile size, number of tile angles, metric) is run in a fresh process so that
+    its peak memory usage (and the one of its worker processes) can be measured.
+    Each phase of a case is run several times (from the same initial state) and
+    its median time recorded, along with its own peak memory usage (on Linux, the
+    peak RSS is reset at the start of each run of a phase):
+    - build_image_library (cold: new pack, warm: incremental update)
+    - load_pixel_library (existing pack)
+    - matching: exact, fast (spatial indexes) and global assignment
+    - image and video output
+    Global assignment is also run on its own, at the metric level, for large
+    smooth sources (many source cells crowding a few library colours) which would
+    require very large generated libraries.
+
+    Results are exported as JSON and can be compared against a baseline
+    (results of a previous run) to flag regressions: phases whose median time is
+    both relatively and absolutely slower """
+import argparse
+import itertools
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import cv2
+import numpy as np
+
+import main
+
+
+SOURCE_SIZES = {
+    "720p": (1280, 720),
+    "1080p": (1920, 1080),
+    "4k": (3840, 2160),
+    "8k": (7680, 4320),
+}
+
+MATCHERS = {
+    # label: (fast, index_label, assignment)
+    "exact": (False, "kdtree", "greedy"),
+    "kdtree": (True, "kdtree", "greedy"),
+    "grid": (True, "grid", "greedy"),
+    "global": (False, "grid", "global"),
+}
+
+def parse_list(value, convert=str):
+    return [convert(v) for v in value.split(",") if v]
+
+def generate_library(libDir, numImages, imageSize=64, seed=0):
+    """ generate <numImages> synthetic library images (random colour gradients
+        with noise) in libDir, images already generated are kept """
+    os.makedirs(libDir, exist_ok=True)
+    existing = len([f for f in os.listdir(libDir) if f.endswith(".png")])
+    if existing == numImages:
+        return
+    shutil.rmtree(libDir)
+    os.makedirs(libDir)
+    rng = np.random.default_rng(seed)
+    ramp = np.linspace(0, 1, imageSize, dtype=np.float32)
+    for index in range(numImages):
+        start, stop = rng.uniform(0, 255, (2, 3)).astype(np.float32)
+        image = start + (stop - start) * ramp[:, None, None]
+        if index % 2:
+            image = image.transpose(1, 0, 2)
+        image = image + rng.normal(0, 12, (imageSize, imageSize, 3)).astype(np.float32)
+        cv2.imwrite(os.path.join(libDir, f"img_{index:06d}.png"), np.clip(image, 0, 255).astype(np.uint8))
+
+def generate_source(filename, width, height, seed=0):
+    """ generate a synthetic source image: smooth random colour field (bicubic
+        upscale of a coarse random image) with noise """
+    if os.path.isfile(filename):
+        return
+    rng = np.random.default_rng(seed)
+    coarse = rng.uniform(0, 255, (max(height // 120, 2), max(width // 120, 2), 3)).astype(np.float32)
+    image = cv2.resize(coarse, (width, height), interpolation=cv2.INTER_CUBIC)
+    image += rng.normal(0, 8, image.shape).astype(np.float32)
+    cv2.imwrite(filename, np.clip(image, 0, 255).astype(np.uint8))
+
+def reset_peak_rss():
+    """ reset the peak resident set size of the process (Linux only)
+        @return False if unsupported """
+    try:
+        with open("/proc/self/clear_refs", "w") as stream:
+            stream.write("5")
+        return True
+    except OSError:
+        return False
+
+def phase_peak_rss():
+    """ return the peak resident set size (kB) of the process since the last
+        reset_peak_rss (VmHWM), None if unavailable """
+    try:
+        with open("/proc/self/status") as stream:
+            for line in stream:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def timed(results, phase, fct, count=None, repeat=1, setup=None):
+    """ run fct <repeat> times within a performance span, record its median
+        timing and the peak RSS of the case process during the phase (worker
+        processes excluded) in results
+        @param setup optional function called (untimed) before each run, fct is
+               then called with its result (fresh state of the phase)
+        @return fct result (last run) """
+    elapsed = []
+    peakRSS = []
+    for _ in range(repeat):
+        state = setup() if setup else None
+        resetRSS = reset_peak_rss()
+        metric = main.PerfMetric(phase)
+        metric.start()
+        value = fct(state) if setup else fct()
+        metric.stop(count)
+        elapsed.append(metric.elapsed)
+        peakRSS.append(phase_peak_rss() if resetRSS else None)
+    median = statistics.median(elapsed)
+    results.append({"phase": phase, "elapsed": median, "runs": elapsed, "count": count,
+                    "throughput": count / max(median, 1e-9) if count else None,
+                    "peak_rss_kb": None if None in peakRSS else max(peakRSS)})
+    return value
+
+def reset_dir(path):
+    """ empty (or create) directory path """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+def run_case(case):
+    """ run a benchmark case (in a dedicated worker process)
+        @return (list of phase results, (peak RSS of the case process, peak RSS
+                of its worker processes)) """
+    random.seed(case["seed"])
+    np.random.seed(case["seed"])
+    tileW = tileH = case["tile_size"]
+    caseDir = os.path.join(case["work_dir"], "cases", case_key(case, with_source=False))
+    tileDir = os.path.join(caseDir, "tiles")
+    if os.path.isdir(caseDir):
+        shutil.rmtree(caseDir)
+    os.makedirs(tileDir)
+    cfg = main.Configuration((tileW, tileH), case["library"], tileDir, jobs=case["jobs"])
+    metric_fct = main.parse_metric(case["metric"])
+    tile_angles = [360.0 * i / case["angles"] for i in range(case["angles"])]
+    results = []
+    numImages = case["library_size"]
+
+    repeat = case["repeat"]
+
+    # each cold build starts from an empty tile directory
+    timed(results, "build_image_library (cold)", lambda _: main.build_image_library(cfg, metric_fct, tile_angles), numImages,
+          repeat, setup=lambda: reset_dir(tileDir))
+    timed(results, "build_image_library (warm)", lambda: main.build_image_library(cfg, metric_fct, tile_angles), numImages, repeat)
+    image_library = timed(results, "load_pixel_library", lambda: main.load_pixel_library(cfg, metric_fct, tile_angles),
+                          numImages * len(tile_angles), repeat)
+
+    source = main.Source(case["source"])
+    numTiles = (source.width // tileW) * (source.height // tileH)
+    tiles = None
+    for label in case["matchers"]:
+        fast, index_label, assignment = MATCHERS[label]
+        matcher = timed(results, f"matcher build ({label})",
+                        lambda: main.build_matcher(image_library, case["random_size"], fast, index_label, assignment, jobs=case["jobs"]),
+                        repeat=repeat)
+        if numTiles > matcher.numAvailable:
+            print(f"[warning] {numTiles} source tiles exceed the library size, {label} matching skipped")
+            continue
+        # each run matches with every library tile available
+        tiles = timed(results, f"matching ({label})", lambda fresh: main.select_tiles(cfg, source.data, metric_fct, image_library, fresh),
+                      numTiles, repeat, setup=matcher.fresh)
+    if tiles is None:
+        return results, main.peak_rss()
+
+    if "image" in case["outputs"]:
+        timed(results, "image output", lambda: main.generateSingleImage(cfg, source, tiles), source.width * source.height, repeat)
+    if "video" in case["outputs"]:
+        frameW, frameH = case["video_size"]
+        videoCfg = main.VideoConfiguration(case["video_frames"], 0, "random")
+        videoFileName = os.path.join(caseDir, "video.avi")
+        timed(results, "video output", lambda: main.generateVideo(cfg, videoCfg, source, tiles, frameW, frameH, videoFileName),
+              case["video_frames"], repeat)
+    return results, main.peak_rss()
+
+def smooth_metrics(numCells, seed=0):
+    """ smooth random colour field (bicubic upscale of a coarse random field) with
+        noise, as the average metrics of a <numCells> cell source (16:10 grid) """
+    rng = np.random.default_rng(seed)
+    width = max(int(round(np.sqrt(numCells * 1.6))), 1)
+    height = -(-numCells // width)
+    coarse = rng.uniform(0, 255, (max(height // 60, 2), max(width // 60, 2), 3)).astype(np.float32)
+    field = cv2.resize(coarse, (width, height), interpolation=cv2.INTER_CUBIC).reshape(-1, 3)[:numCells]
+    return field + rng.normal(0, 4, field.shape).astype(np.float32)
+
+def run_assignment_case(case):
+    """ run a global assignment case (in a dedicated worker process): a smooth
+        source metric field against uniformly distributed library metrics
+        @return (list of phase results, (peak RSS of the case process, peak RSS
+                of its worker processes)) """
+    numCells, librarySize = case["cells"], case["library_size"]
+    libMetrics = np.random.default_rng(case["seed"]).uniform(0, 255, (librarySize, 3)).astype(np.float32)
+    srcMetrics = smooth_metrics(numCells, case["seed"])
+    results = []
+    matcher = timed(results, f"matcher build ({numCells // 1000}k cells)",
+                    lambda: main.GlobalMatcher(main.GridIndex(libMetrics)), repeat=case["repeat"])
+    timed(results, f"global assignment ({numCells // 1000}k cells)", lambda fresh: fresh.match(srcMetrics), numCells,
+          case["repeat"], setup=matcher.fresh)
+    return results, main.peak_rss()
+
+def case_key(case, with_source=True):
+    """ string identifying a benchmark case (used to match baseline results) """
+    key = f"lib{case['library_size']}_tile{case['tile_size']}_angles{case['angles']}_{case['metric']}"
+    if with_source:
+        key += f"_{case['source_label']}"
+    return key
+
+def print_scaling(records):
+    """ print throughput and peak memory of each phase, and peak memory of each
+        case, as a function of the library size """
+    sizes = sorted({record["library_size"] for record in records})
+    phases = list(dict.fromkeys(record["phase"] for record in records))
+    groups = {}
+    for record in records:
+        group = (record["phase"], record["source_label"], record["tile_size"], record["angles"], record["metric"])
+        groups.setdefault(group, {})[record["library_size"]] = record
+    groups = dict(sorted(groups.items(), key=lambda item: item[0][1:] + (phases.index(item[0][0]),)))
+    print("\nthroughput (item(s)/s) / phase peak RSS (MB, case process) by library size")
+    print(f"{'phase':32} {'source':6} {'tile':>4} {'ang':>3} {'metric':8} " + " ".join(f"{size:>18}" for size in sizes))
+    for (phase, sourceLabel, tileSize, angles, metric), bySize in groups.items():
+        cells = []
+        for size in sizes:
+            record = bySize.get(size)
+            if record is None:
+                cells.append(f"{'-':>18}")
+            else:
+                throughput = f"{record['throughput']:.4g}" if record["throughput"] else f"{record['elapsed']:.3g}s"
+                rss = f"{record['peak_rss_kb'] / 1024:.0f}" if record["peak_rss_kb"] is not None else "?"
+                cells.append(f"{throughput + ' / ' + rss:>18}")
+        print(f"{phase:32} {sourceLabel:6} {tileSize:>4} {angles:>3} {metric:8} " + " ".join(cells))
+
+    cases = {}
+    for record in records:
+        cases.setdefault((record["source_label"], record["tile_size"], record["angles"], record["metric"]), {})[record["library_size"]] = record
+    print("\npeak RSS (MB) of each case: case process / worker processes")
+    print(f"{'source':6} {'tile':>4} {'ang':>3} {'metric':8} " + " ".join(f"{size:>18}" for size in sizes))
+    for (sourceLabel, tileSize, angles, metric), bySize in sorted(cases.items()):
+        cells = []
+        for size in sizes:
+            record = bySize.get(size)
+            if record is None or record["case_peak_rss_kb"] is None:
+                cells.append(f"{'-':>18}")
+            else:
+                cells.append(f"{record['case_peak_rss_kb'] / 1024:.0f} / {record['case_workers_peak_rss_kb'] / 1024:.0f}".rjust(18))
+        print(f"{sourceLabel:6} {tileSize:>4} {angles:>3} {metric:8} " + " ".join(cells))
+
+def compare_baseline(records, baseline, tolerance, minTime):
+    """ compare (median) elapsed times with the baseline ones, differences below
+        minTime seconds being ignored (timer and scheduling noise of short phases)
+        @return list of regression descriptions """
+    reference = {(record["case"], record["phase"]): record for record in baseline["results"]}
+    regressions = []
+    print(f"\ncomparison with baseline (tolerance {tolerance:.0%}, minimum difference {minTime:.3g}s)")
+    for record in records:
+        base = reference.get((record["case"], record["phase"]))
+        if base is None:
+            continue
+        ratio = record["elapsed"] / max(base["elapsed"], 1e-9)
+        significant = abs(record["elapsed"] - base["elapsed"]) >= minTime
+        flag = ""
+        if ratio > 1 + tolerance and significant:
+            flag = "REGRESSION"
+            regressions.append(f"{record['case']} {record['phase']}: {base['elapsed']:.3g}s -> {record['elapsed']:.3g}s")
+        elif ratio < 1 / (1 + tolerance) and significant:
+            flag = "improvement"
+        print(f"{record['case']:40} {record['phase']:32} {base['elapsed']:10.3g}s {record['elapsed']:10.3g}s  x{ratio:.2f} {flag}")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="azulejo benchmark harness (synthetic libraries and sources)")
+    parser.add_argument("--work-dir", default="./.bench", type=str, help="directory of the generated libraries, sources and case outputs")
+    parser.add_argument("--library-sizes", default=[1000], type=(lambda s: parse_list(s, int)), help="comma separated list of library sizes (number of images)")
+    parser.add_argument("--sources", default=["720p"], type=parse_list, help=f"comma separated list of source sizes among {', '.join(SOURCE_SIZES)}")
+    parser.add_argument("--tile-sizes", default=[32], type=(lambda s: parse_list(s, int)), help="comma separated list of (square) tile sizes")
+    parser.add_argument("--angles", default=[1], type=(lambda s: parse_list(s, int)), help="comma separated list of tile angle counts")
+    parser.add_argument("--metrics", default=["average"], type=parse_list, help="comma separated list of metrics (average, palette, sub)")
+    parser.add_argument("--matchers", default=list(MATCHERS), type=parse_list, help=f"comma separated list of matchers among {', '.join(MATCHERS)}")
+    parser.add_argument("--outputs", default=["image", "video"], type=parse_list, help="comma separated list of outputs (image, video)")
+    parser.add_argument("--video-frames", default=10, type=int, help="number of frames of the video output")
+    parser.add_argument("--video-size", default=(640, 360), type=(lambda s: tuple(parse_list(s, int))), help="frame size of the video output")
+    parser.add_argument("--assignment-sizes", default=[(100000, 200000)], type=(lambda s: parse_list(s, lambda v: tuple(int(n) for n in v.split(":")))),
+                        help="comma separated list of <source cells>:<library size> global assignment cases (smooth source metrics), empty: none")
+    parser.add_argument("--random-size", default=6, type=int, help="size of the closest tile set to chose from")
+    parser.add_argument("--jobs", default=None, type=int, help="number of worker processes/threads of each case, default: one per cpu")
+    parser.add_argument("--seed", default=0, type=int, help="random seed (synthetic data and tile selection)")
+    parser.add_argument("--output", default="benchmark.json", type=str, help="result file (json)")
+    parser.add_argument("--baseline", default=None, type=str, help="result file of a previous run to compare with")
+    parser.add_argument("--repeat", default=3, type=int, help="number of runs of each phase, the median time is recorded")
+    parser.add_argument("--tolerance", default=0.2, type=float, help="relative slowdown above which a phase is flagged as a regression")
+    parser.add_argument("--min-time", default=0.05, type=float, help="absolute slowdown (seconds) below which a phase is never flagged as a regression")
+    args = parser.parse_args()
+
+    for sourceLabel in args.sources:
+        if sourceLabel not in SOURCE_SIZES:
+            raise Exception(f"unknown source size {sourceLabel}")
+    for label in args.matchers:
+        if label not in MATCHERS:
+            raise Exception(f"unknown matcher {label}")
+
+    print("generating synthetic data")
+    os.makedirs(args.work_dir, exist_ok=True)
+    for size in args.library_sizes:
+        generate_library(os.path.join(args.work_dir, f"library_{size}"), size, seed=args.seed)
+    for sourceLabel in args.sources:
+        generate_source(os.path.join(args.work_dir, f"source_{sourceLabel}.png"), *SOURCE_SIZES[sourceLabel], seed=args.seed)
+
+    records = []
+    for size, tileSize, angles, metric, sourceLabel in itertools.product(args.library_sizes, args.tile_sizes, args.angles, args.metrics, args.sources):
+        case = {
+            "work_dir": args.work_dir, "library": os.path.join(args.work_dir, f"library_{size}"), "library_size": size,
+            "source": os.path.join(args.work_dir, f"source_{sourceLabel}.png"), "source_label": sourceLabel,
+            "tile_size": tileSize, "angles": angles, "metric": metric, "matchers": args.matchers, "outputs": args.outputs,
+            "video_frames": args.video_frames, "video_size": args.video_size, "random_size": args.random_size,
+            "jobs": args.jobs, "seed": args.seed, "repeat": args.repeat,
+        }
+        print(f"running case {case_key(case)}")
+        # each case runs in a fresh process: its peak RSS (and the one of its
+        # worker processes) is measured per case
+        with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+            caseResults, (casePeakRSS, workersPeakRSS) = executor.submit(run_case, case).result()
+        for result in caseResults:
+            result.update({"case": case_key(case), "library_size": size, "source_label": sourceLabel,
+                           "tile_size": tileSize, "angles": angles, "metric": metric,
+                           "case_peak_rss_kb": casePeakRSS, "case_workers_peak_rss_kb": workersPeakRSS})
+            records.append(result)
+            print(f"  {result['phase']:32} {result['elapsed']:.3g} second(s) (median of {len(result['runs'])})")
+
+    for numCells, size in args.assignment_sizes:
+        case = {"cells": numCells, "library_size": size, "seed": args.seed, "repeat": args.repeat}
+        key = f"assignment{numCells}_lib{size}"
+        print(f"running case {key}")
+        with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+            caseResults, (casePeakRSS, workersPeakRSS) = executor.submit(run_assignment_case, case).result()
+        for result in caseResults:
+            result.update({"case": key, "library_size": size, "source_label": "smooth",
+                           "tile_size": "-", "angles": "-", "metric": "average",
+                           "case_peak_rss_kb": casePeakRSS, "case_workers_peak_rss_kb": workersPeakRSS})
+            records.append(result)
+            print(f"  {result['phase']:32} {result['elapsed']:.3g} second(s) (median of {len(result['runs'])})")
+
+    print_scaling(records)
+    with open(args.output, "w") as stream:
+        json.dump({"date": time.strftime("%Y-%m-%d %H:%M:%S"), "config": vars(args), "results": records}, stream, indent=2)
+    print(f"\nresults saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as stream:
+            baseline = json.load(stream)
+        regressions = compare_baseline(records, baseline, args.tolerance, args.min_time)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s):")
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
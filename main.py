@@ -1,14 +1,36 @@
 import argparse
 import cv2
+import sys
+import csv
+import cProfile
+import pstats
+import tracemalloc
 import random
 import math
 import time
 import re
+import json
+import heapq
+import io
+import collections
+import itertools
+import copy
+import queue
+import threading
+import weakref
 
 import numpy as np
 
 import os
 from os.path import isfile, join
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+try:
+    import resource
+except ImportError:
+    # peak memory usage is not reported on platforms without resource (Windows)
+    resource = None
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 
 def parse_metric(metric_label):
@@ -31,21 +53,631 @@ def average_metric(img):
     return avg
 
 def palette_metric(img):
-    # determine a dominant "color" by clustering colors in 5 palettes
-    n_colors = 5
-    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 200, .1)
-    flags = cv2.KMEANS_RANDOM_CENTERS
-    flatten_img = np.float32(img.view().reshape(-1, 3))
-
-    _, labels, palette = cv2.kmeans(flatten_img, n_colors, criteria, 10, flags)
-    _, counts = np.unique(labels, return_counts=True)
-    dominant = palette[np.argmax(counts)]
-    return dominant
+    # determine a dominant "color" by quantizing colors in a coarse palette
+    return palette_grid_metric(img, img.shape[1], img.shape[0])[0, 0]
 
 def sub_metric(img):
     return cv2.resize(cv2.cvtColor(img, (cv2.COLOR_BGR2GRAY)), (4, 4)).reshape(1, -1)
 
+def tile_grid_view(img, tileW, tileH):
+    """ return a zero-copy (ny, nx, tileH, tileW, ...) view of the tiles of img
+        (incomplete tiles on the right and bottom borders are ignored) """
+    ny, nx = img.shape[0] // tileH, img.shape[1] // tileW
+    grid = img[:ny * tileH, :nx * tileW]
+    return grid.reshape((ny, tileH, nx, tileW) + img.shape[2:]).swapaxes(1, 2)
+
+def average_grid_metric(img, tileW, tileH):
+    return tile_grid_view(img, tileW, tileH).mean(axis=(2, 3))
+
+# number of quantization levels per color channel of the palette metric
+PALETTE_LEVELS = 4
+
+def palette_grid_metric(img, tileW, tileH, chunkSize=4096):
+    # the colors of each tile are binned in a PALETTE_LEVELS^3 histogram, the dominant
+    # color is the mean color of the pixels of the most populated bin.
+    # Tiles are processed by chunks to bound the size of the histograms
+    grid = tile_grid_view(img, tileW, tileH)
+    ny, nx = grid.shape[:2]
+    numBins = PALETTE_LEVELS ** 3
+    shift = 8 - int(math.log2(PALETTE_LEVELS))
+    tiles = grid.reshape(ny * nx, tileH * tileW, 3)
+    dominant = np.empty((ny * nx, 3), dtype=np.float32)
+    for start in range(0, ny * nx, chunkSize):
+        pixels = tiles[start:start + chunkSize]
+        quantized = (pixels >> shift).astype(np.int64)
+        bins = (quantized[..., 0] * PALETTE_LEVELS + quantized[..., 1]) * PALETTE_LEVELS + quantized[..., 2]
+        # a distinct set of bins for each tile
+        offsets = np.arange(len(pixels))[:, None] * numBins
+        counts = np.bincount((bins + offsets).ravel(), minlength=len(pixels) * numBins).reshape(len(pixels), numBins)
+        mask = bins == counts.argmax(axis=1)[:, None]
+        dominant[start:start + len(pixels)] = np.einsum("tp,tpc->tc", mask, pixels, dtype=np.float32) / mask.sum(axis=1, keepdims=True)
+    return dominant.reshape(ny, nx, 3)
+
+def sub_grid_metric(img, tileW, tileH):
+    # resizing the whole image samples the same pixels as resizing each tile
+    ny, nx = img.shape[0] // tileH, img.shape[1] // tileW
+    gray = cv2.cvtColor(np.ascontiguousarray(img[:ny * tileH, :nx * tileW]), cv2.COLOR_BGR2GRAY)
+    return tile_grid_view(cv2.resize(gray, (nx * 4, ny * 4)), 4, 4).reshape(ny, nx, 16)
+
+# vectorized versions of the metric functions, evaluating a metric
+# on every tile of an image in a single pass
+grid_metric_fcts = {
+    average_metric: average_grid_metric,
+    palette_metric: palette_grid_metric,
+    sub_metric: sub_grid_metric,
+}
+
+def grid_metrics(img, tileW, tileH, metric_fct):
+    """ evaluate metric_fct on every (tileW x tileH) tile of img
+        @return float32 array (ny x nx x metric size) """
+    ny, nx = img.shape[0] // tileH, img.shape[1] // tileW
+    if not ny or not nx:
+        # image smaller than a tile: the metric size is the one of a blank tile
+        blank = np.zeros((tileH, tileW) + img.shape[2:], dtype=img.dtype)
+        return np.zeros((ny, nx, np.asarray(metric_fct(blank)).size), dtype=np.float32)
+    if metric_fct in grid_metric_fcts:
+        metrics = grid_metric_fcts[metric_fct](img, tileW, tileH)
+    else:
+        metrics = [[np.asarray(metric_fct(tile)).reshape(-1) for tile in row] for row in tile_grid_view(img, tileW, tileH)]
+    return np.asarray(metrics, dtype=np.float32).reshape(ny, nx, -1)
+
+
+
+# packed library layout: for each tile size, a directory containing
+# - a contiguous uint8 tile tensor (N x tileH x tileW x 3) stored as .npy
+# - a json index (manifest) listing, for each tile, the thumbnail filename and
+#   the source filename, size and modification time
+# - float32 metric matrices (N x metric size), one per metric and angle
+PACK_TILES = "tiles.npy"
+PACK_INDEX = "index.json"
+
+def get_pack_dir(tile_dir, tileW, tileH):
+    """ return the directory of the packed library for a given tile size """
+    return join(tile_dir, "pack_{}x{}".format(tileW, tileH))
+
+def save_array(path, array):
+    """ atomically save a numpy array to <path> (.npy format) """
+    tmpPath = path + ".tmp"
+    with open(tmpPath, "wb") as stream:
+        np.save(stream, array)
+    os.replace(tmpPath, path)
+
+def write_library_pack(pack_dir, tile_blocks, entries, keep_metrics=False):
+    """ write a packed library
+        @param pack_dir destination directory
+        @param tile_blocks list of uint8 arrays of tiles (n x tileH x tileW x 3),
+               concatenated in the pack
+        @param entries list of N manifest entries (one dict per tile)
+        @param keep_metrics keep metric caches of the previous pack, only valid
+               if the new pack extends the previous one
+
+        Cached metrics of a previous pack are discarded """
+    numTiles = sum(block.shape[0] for block in tile_blocks)
+    assert len(entries) == numTiles
+    os.makedirs(pack_dir, exist_ok=True)
+    if not keep_metrics:
+        for f in os.listdir(pack_dir):
+            if f.startswith("metric_"):
+                os.remove(join(pack_dir, f))
+    tilesPath = join(pack_dir, PACK_TILES)
+    # tiles are copied block by block in a memory-mapped file, avoiding
+    # a full copy of the library in memory
+    tiles = np.lib.format.open_memmap(tilesPath + ".tmp", mode="w+", dtype=np.uint8,
+                                      shape=(numTiles,) + tile_blocks[0].shape[1:])
+    offset = 0
+    for block in tile_blocks:
+        tiles[offset:offset + block.shape[0]] = block
+        offset += block.shape[0]
+    tiles.flush()
+    del tiles
+    os.replace(tilesPath + ".tmp", tilesPath)
+    tmpPath = join(pack_dir, PACK_INDEX + ".tmp")
+    with open(tmpPath, "w") as stream:
+        json.dump({"entries": entries}, stream)
+    os.replace(tmpPath, join(pack_dir, PACK_INDEX))
+
+def open_library_pack(pack_dir):
+    """ memory-map a packed library (no image decoding involved)
+        @return (tiles, entries) or None if there is no valid pack in pack_dir """
+    tilesPath = join(pack_dir, PACK_TILES)
+    indexPath = join(pack_dir, PACK_INDEX)
+    if not (isfile(tilesPath) and isfile(indexPath)):
+        return None
+    tiles = np.load(tilesPath, mmap_mode="r")
+    with open(indexPath) as stream:
+        entries = json.load(stream)["entries"]
+    if len(entries) != tiles.shape[0]:
+        print(f"[warning] inconsistent library pack in {pack_dir}, ignoring it")
+        return None
+    return tiles, entries
+
+class PackWriter:
+    """ append tiles to a library pack in place: tiles are written at the end of
+        the .npy tile file, whose header (array shape) and the pack index are only
+        updated by close(). Existing tiles and metric caches are left untouched,
+        a pack whose update is interrupted keeps its previous content """
+    headerFormats = {(1, 0): (np.lib.format.read_array_header_1_0, np.lib.format.write_array_header_1_0),
+                     (2, 0): (np.lib.format.read_array_header_2_0, np.lib.format.write_array_header_2_0)}
+
+    def __init__(self, pack_dir):
+        self.packDir = pack_dir
+        self.tilesPath = join(pack_dir, PACK_TILES)
+        _, entries = open_library_pack(pack_dir)
+        self.entries = list(entries)
+        self.stream = open(self.tilesPath, "r+b")
+        self.version = np.lib.format.read_magic(self.stream)
+        readHeader, _ = self.headerFormats[self.version]
+        shape, _, self.dtype = readHeader(self.stream)
+        self.dataOffset = self.stream.tell()
+        self.numTiles, self.tileShape = shape[0], shape[1:]
+        self.appended = 0
+        # drop the tiles of an interrupted update
+        self.stream.seek(self.dataOffset + self.numTiles * int(np.prod(self.tileShape)) * self.dtype.itemsize)
+        self.stream.truncate()
+
+    def append(self, tiles, entries):
+        """ append a block of tiles (n x tileH x tileW x 3) and their index entries """
+        assert tiles.shape[1:] == self.tileShape and len(tiles) == len(entries)
+        self.stream.write(np.ascontiguousarray(tiles, dtype=self.dtype).data)
+        self.numTiles += len(tiles)
+        self.appended += len(tiles)
+        self.entries += entries
+
+    def close(self):
+        """ commit the appended tiles (update the tile file header and the index)
+            @return the updated pack (tiles, entries) """
+        _, writeHeader = self.headerFormats[self.version]
+        header = io.BytesIO()
+        writeHeader(header, {"descr": np.lib.format.dtype_to_descr(self.dtype), "fortran_order": False,
+                             "shape": (self.numTiles,) + self.tileShape})
+        if not self.appended:
+            self.stream.close()
+        elif len(header.getvalue()) == self.dataOffset:
+            self.stream.seek(0)
+            self.stream.write(header.getvalue())
+            self.stream.close()
+            tmpPath = join(self.packDir, PACK_INDEX + ".tmp")
+            with open(tmpPath, "w") as stream:
+                json.dump({"entries": self.entries}, stream)
+            os.replace(tmpPath, join(self.packDir, PACK_INDEX))
+        else:
+            # no spare space in the header for the new shape: the pack is rewritten
+            self.stream.close()
+            tiles = np.memmap(self.tilesPath, dtype=self.dtype, mode="r", offset=self.dataOffset, shape=(self.numTiles,) + self.tileShape)
+            write_library_pack(self.packDir, [tiles], self.entries, keep_metrics=True)
+            del tiles
+        return open_library_pack(self.packDir)
+
+def update_pack_writer(pack_dir, pack, kept_rows, tileW, tileH, blockSize=1024):
+    """ start the update of a library pack, keeping the tiles at <kept_rows> (sorted)
+        of the previous pack
+        @return a PackWriter to which new tiles are appended """
+    if pack is None or kept_rows != list(range(len(pack[1]))):
+        # new pack, or tiles have been removed or modified: the pack is rebuilt
+        # (from the tiles of the previous pack which are still valid), metric
+        # caches are discarded
+        write_library_pack(pack_dir, [stack_tiles([], tileW, tileH)], [])
+        writer = PackWriter(pack_dir)
+        for start in range(0, len(kept_rows), blockSize):
+            rows = kept_rows[start:start + blockSize]
+            writer.append(pack[0][rows], [pack[1][row] for row in rows])
+        return writer
+    # the pack is only extended: new tiles are appended in place, existing
+    # tiles and metric caches remain valid
+    return PackWriter(pack_dir)
+
+def stack_tiles(tiles, tileW, tileH):
+    """ stack a list of tiles in a contiguous uint8 tensor """
+    if not tiles:
+        return np.zeros((0, tileH, tileW, 3), np.uint8)
+    return np.stack(tiles)
+
+def rotate_tile(tile, rot_angle):
+    """ rotate a tile around its center """
+    if rot_angle == 0:
+        return tile
+    tileH, tileW = tile.shape[:2]
+    M = cv2.getRotationMatrix2D((tileW/2, tileH/2), rot_angle, 1)
+    return cv2.warpAffine(tile, M, (tileW, tileH))
+
+def parallel_map(fct, tasks, jobs=None, chunksize=8):
+    """ lazily map fct over tasks with a pool of <jobs> worker processes
+        (jobs=None: one process per cpu), small workloads are processed inline """
+    if jobs is None:
+        jobs = os.cpu_count()
+    if jobs <= 1 or len(tasks) <= chunksize:
+        yield from map(fct, tasks)
+    else:
+        with ProcessPoolExecutor(jobs) as executor:
+            yield from executor.map(fct, tasks, chunksize=chunksize)
+
+def make_thumbnail(task):
+    """ generate (or reload) the thumbnail of an image (library builder worker)
+        @param task (filename, thumb_path, tileW, tileH, reuse_thumb), thumb_path
+               being None if the thumbnail is not saved as an image file
+        @return the thumbnail or None if the image could not be processed """
+    filename, thumb_path, tileW, tileH, reuse_thumb = task
+    if reuse_thumb and thumb_path and isfile(thumb_path):
+        thumb = cv2.imread(thumb_path)
+        if thumb is not None and thumb.shape == (tileH, tileW, 3):
+            return thumb
+    picture = cv2.imread(filename)
+    if picture is None:
+        return None
+    thumb = cv2.resize(picture, (tileW, tileH))
+    if thumb_path:
+        cv2.imwrite(thumb_path, thumb)
+    return thumb
+
+def evaluate_metrics(task):
+    """ evaluate a metric on a block of tiles rotated by each angle (library builder worker)
+        @param task (tiles, metric_fct, tile_angles)
+        @return list of float32 metric matrices, one per angle """
+    tiles, metric_fct, tile_angles = task
+    numTiles, tileH, tileW = tiles.shape[:3]
+    metrics = []
+    for rot_angle in tile_angles:
+        rotated = tiles if rot_angle == 0 else np.array([rotate_tile(tile, rot_angle) for tile in tiles])
+        # the stack of tiles is seen as a single column of tiles
+        metrics.append(grid_metrics(rotated.reshape(numTiles * tileH, tileW, 3), tileW, tileH, metric_fct).reshape(numTiles, -1))
+    return metrics
+
+def load_pack_metrics(pack_dir, tiles, metric_fct, tile_angles, jobs=None, blockSize=256):
+    """ return the float32 metric matrices of the pack tiles rotated by each angle
+        of tile_angles
+
+        Matrices are read from the pack if they have already been evaluated,
+        else they are evaluated (only for the tiles missing from the cached matrices)
+        and saved in the pack. Rotated tiles only exist during metric evaluation """
+    paths = [join(pack_dir, "metric_{}_{:g}.npy".format(metric_fct.__name__, rot_angle)) for rot_angle in tile_angles]
+    cached = []
+    for path in paths:
+        metrics = np.load(path, mmap_mode="r") if isfile(path) else None
+        if metrics is not None and (metrics.shape[0] > tiles.shape[0] or metrics.shape[0] == 0):
+            metrics = None
+        cached.append(metrics)
+    missing = [angleId for angleId, metrics in enumerate(cached) if metrics is None or metrics.shape[0] < tiles.shape[0]]
+    PerfMetric.addCounter("metric cache hits", sum(0 if metrics is None else metrics.shape[0] for metrics in cached))
+    if not missing:
+        return cached
+    start = min((0 if cached[angleId] is None else cached[angleId].shape[0]) for angleId in missing)
+    metricPerf = PerfMetric(f"metric {metric_fct.__name__}")
+    metricPerf.start()
+    missingAngles = [tile_angles[angleId] for angleId in missing]
+    tasks = [(np.array(tiles[i:i+blockSize]), metric_fct, missingAngles) for i in range(start, tiles.shape[0], blockSize)]
+    blocks = list(parallel_map(evaluate_metrics, tasks, jobs, chunksize=1))
+    for blockId, angleId in enumerate(missing):
+        angleBlocks = [block[blockId] for block in blocks]
+        if start > 0:
+            angleBlocks.insert(0, cached[angleId][:start])
+        cached[angleId] = np.concatenate(angleBlocks)
+        save_array(paths[angleId], cached[angleId])
+    metricPerf.stop((tiles.shape[0] - start) * len(missing))
+    PerfMetric.addCounter("library metric evaluations", metricPerf.count)
+    return cached
+
+class TileLibrary:
+    """ struct-of-arrays tile library: library tile i is the base tile
+        tiles[tileIds[i]] rotated by angles[angleIds[i]], its metric being
+        metrics[i].
+        - tiles: contiguous uint8 (N x tileH x tileW x 3) base tile array (the
+          memory-mapped pack tiles)
+        - metrics: float32 (len x metric size) matrix
+        - tileIds, angleIds: provenance arrays, entries[tileIds[i]] being the
+          pack index entry of the base tile
+        Sub-libraries (sampling, filtering) are index views sharing the base
+        tiles. Base tiles are only rotated when they are actually used """
+    def __init__(self, tiles, metrics, tileIds, angleIds, angles, entries=None):
+        self.tiles = tiles
+        self.metrics = metrics
+        self.tileIds = tileIds
+        self.angleIds = angleIds
+        self.angles = angles
+        self.entries = entries
+
+    @staticmethod
+    def fromPack(tiles, entries, angleMetrics, tile_angles):
+        """ build the library of every (base tile, angle) pair, grouped by angle
+            @param angleMetrics list of per-angle metric arrays (one row per base tile) """
+        numTiles = tiles.shape[0]
+        metrics = np.concatenate([np.asarray(metrics, dtype=np.float32).reshape(numTiles, -1) for metrics in angleMetrics])
+        tileIds = np.tile(np.arange(numTiles), len(tile_angles))
+        angleIds = np.repeat(np.arange(len(tile_angles)), numTiles)
+        return TileLibrary(tiles, metrics, tileIds, angleIds, list(tile_angles), entries)
+
+    def __len__(self):
+        return len(self.tileIds)
+
+    def select(self, indices):
+        """ return the sub-library of the tiles at <indices> (sharing the base tiles) """
+        return TileLibrary(self.tiles, self.metrics[indices], self.tileIds[indices], self.angleIds[indices], self.angles, self.entries)
+
+    def filter(self, mask):
+        """ return the sub-library of the tiles selected by a boolean mask """
+        return self.select(np.flatnonzero(mask))
+
+    def sample(self, sampling):
+        """ return a random sub-library of (at most) <sampling> distinct tiles """
+        if sampling >= len(self):
+            return self
+        return self.select(np.sort(random.sample(range(len(self)), sampling)))
+
+    def tilePixels(self, indices):
+        """ return the (rotated) pixels of the tiles at <indices> as a contiguous
+            uint8 (len(indices) x tileH x tileW x 3) array """
+        indices = np.asarray(indices, dtype=np.int64)
+        pixels = np.array(self.tiles[self.tileIds[indices]])
+        for angleId in np.unique(self.angleIds[indices]):
+            if self.angles[angleId] != 0:
+                for row in np.flatnonzero(self.angleIds[indices] == angleId):
+                    pixels[row] = rotate_tile(pixels[row], self.angles[angleId])
+        return pixels
+
+# maximal mean colour distance between near-duplicate tiles
+DEDUP_COLOR_DISTANCE = 12.0
+
+def tile_hashes(tiles):
+    """ return the 64-bit difference hashes (dHash: sign of the horizontal
+        gradients of the 9x8 grayscale thumbnail) and the mean colours of tiles """
+    hashes = np.empty(len(tiles), dtype=np.uint64)
+    weights = (1 << np.arange(63, -1, -1, dtype=np.uint64))
+    for index, tile in enumerate(tiles):
+        small = cv2.resize(cv2.cvtColor(np.ascontiguousarray(tile), cv2.COLOR_BGR2GRAY), (9, 8), interpolation=cv2.INTER_AREA)
+        bits = (small[:, 1:] > small[:, :-1]).reshape(-1)
+        hashes[index] = np.bitwise_or.reduce(weights[bits]) if bits.any() else 0
+    colors = np.asarray(tiles).reshape(len(tiles), -1, 3).mean(axis=1, dtype=np.float32) if len(tiles) else np.zeros((0, 3), np.float32)
+    return hashes, colors
+
+def load_pack_hashes(pack_dir, tiles, blockSize=4096):
+    """ return the perceptual hashes and mean colours of the pack tiles, cached in
+        the pack like metric matrices (and evaluated only for missing tiles) """
+    path = join(pack_dir, "metric_dhash.npy")
+    cached = np.load(path) if isfile(path) else None
+    if cached is not None and cached.shape[0] > tiles.shape[0]:
+        cached = None
+    start = 0 if cached is None else cached.shape[0]
+    if start == tiles.shape[0]:
+        return cached["hash"], cached["color"]
+    records = np.empty(tiles.shape[0], dtype=[("hash", np.uint64), ("color", np.float32, 3)])
+    if start:
+        records[:start] = cached
+    for blockStart in range(start, tiles.shape[0], blockSize):
+        block = tiles[blockStart:blockStart + blockSize]
+        records["hash"][blockStart:blockStart + len(block)], records["color"][blockStart:blockStart + len(block)] = tile_hashes(block)
+    save_array(path, records)
+    return records["hash"], records["color"]
+
+def popcount(values):
+    """ number of set bits of each uint64 value """
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    return np.unpackbits(values.view(np.uint8).reshape(len(values), 8), axis=1).sum(axis=1)
+
+def bucket_pairs(queries, starts, counts, order, maxPairs):
+    """ yield the (query, candidate) pairs of each query and of every tile of its
+        bucket (order[start:start + count]), by batches of (about) maxPairs pairs """
+    nonEmpty = counts > 0
+    queries, starts, counts = queries[nonEmpty], starts[nonEmpty], counts[nonEmpty]
+    ends = np.cumsum(counts)
+    batchStart = 0
+    while batchStart < len(queries):
+        batchEnd = max(int(np.searchsorted(ends, ends[batchStart] - counts[batchStart] + maxPairs, side="right")), batchStart + 1)
+        batchCounts = counts[batchStart:batchEnd]
+        offsets = np.repeat(np.cumsum(batchCounts) - batchCounts - starts[batchStart:batchEnd], batchCounts)
+        yield np.repeat(queries[batchStart:batchEnd], batchCounts), order[np.arange(len(offsets)) - offsets]
+        batchStart = batchEnd
+
+def near_duplicate_clusters(hashes, colors, maxDistance, numChunks=4, crowdedBucket=64, maxPairs=1 << 20):
+    """ cluster near-duplicate tiles: hashes within <maxDistance> (Hamming) bits and
+        mean colours within DEDUP_COLOR_DISTANCE.
+
+        Tiles with identical hashes and mean colours (exact copies) are merged
+        first, only the first tile of each group being looked up.
+        Candidate pairs are then found with a multi-index hash lookup: hashes are
+        split in <numChunks> 16-bit chunks, two hashes within maxDistance bits have
+        at least one chunk within maxDistance // numChunks bits, which are looked up
+        (by enumerating the chunk bit flips) in chunk value buckets. Chunk buckets
+        of more than <crowdedBucket> tiles (flat images all share the same hash)
+        are split by mean colour cell (of side 2 * DEDUP_COLOR_DISTANCE), the 8
+        cells around the query colour being looked up. Candidate pairs are
+        generated by batches of (about) <maxPairs> pairs and verified, clusters of
+        the verified pairs are merged with a union-find
+        @return array of the cluster representative (smallest index) of each tile """
+    numTiles = len(hashes)
+    _, groupFirst, groupIds = np.unique(np.column_stack([hashes.view(np.int64), colors.view(np.int32)]), axis=0, return_index=True, return_inverse=True)
+    parent = groupFirst[groupIds.reshape(-1)]
+    reps = np.sort(groupFirst)
+    repHashes, repColors = hashes[reps], colors[reps]
+
+    chunkBits = 64 // numChunks
+    chunkValues = np.arange(1 << chunkBits, dtype=np.uint64)
+    flips = chunkValues[popcount(chunkValues) <= maxDistance // numChunks].astype(np.int64)
+    # colour cells of each tile and the 8 cells overlapping the box of the
+    # colours within DEDUP_COLOR_DISTANCE, (chunk value, colour cell) keys are
+    # hashed (tabulation hashing) in a table of 2^tableBits slots, collisions
+    # being filtered out by the pair verification
+    side = 2 * DEDUP_COLOR_DISTANCE
+    base = int(256 // side) + 3
+    def cell_ids(cells):
+        return ((cells[:, 0] + 1) * base + cells[:, 1] + 1) * base + cells[:, 2] + 1
+    tableBits = max(int(np.ceil(np.log2(max(len(reps), 2)))) + 1, 16)
+    hashRng = np.random.default_rng(0)
+    chunkSlots = hashRng.integers(0, 1 << tableBits, 1 << chunkBits)
+    cellSlots = hashRng.integers(0, 1 << tableBits, base ** 3)
+    repCells = cellSlots[cell_ids(np.floor(repColors / side).astype(np.int64))]
+    lowCells = np.floor((repColors - DEDUP_COLOR_DISTANCE) / side).astype(np.int64)
+    neighbourCells = [cellSlots[cell_ids(lowCells + np.array(offset))] for offset in itertools.product((0, 1), repeat=3)]
+
+    pairs = []
+    for chunkId in range(numChunks):
+        chunks = ((repHashes >> np.uint64(chunkId * chunkBits)) & np.uint64((1 << chunkBits) - 1)).astype(np.int64)
+        # tiles sorted by chunk value and by (chunk value, colour cell) slot,
+        # with the offset and size of each bucket
+        chunkOrder = np.argsort(chunks, kind="stable")
+        chunkSize = np.bincount(chunks, minlength=1 << chunkBits)
+        chunkStart = np.cumsum(chunkSize) - chunkSize
+        tileSlots = chunkSlots[chunks] ^ repCells
+        slotOrder = np.argsort(tileSlots, kind="stable")
+        slotSize = np.bincount(tileSlots, minlength=1 << tableBits)
+        slotStart = np.cumsum(slotSize) - slotSize
+        for flip in flips:
+            target = chunks ^ flip
+            counts = chunkSize[target]
+            sparse = np.flatnonzero(counts <= crowdedBucket)
+            lookups = [bucket_pairs(sparse, chunkStart[target[sparse]], counts[sparse], chunkOrder, maxPairs)]
+            crowded = np.flatnonzero(counts > crowdedBucket)
+            for cells in neighbourCells:
+                slots = chunkSlots[target[crowded]] ^ cells[crowded]
+                lookups.append(bucket_pairs(crowded, slotStart[slots], slotSize[slots], slotOrder, maxPairs))
+            for queries, candidates in itertools.chain(*lookups):
+                candidate = queries < candidates
+                queries, candidates = queries[candidate], candidates[candidate]
+                colorDelta = repColors[queries] - repColors[candidates]
+                close = ((popcount(repHashes[queries] ^ repHashes[candidates]) <= maxDistance)
+                         & (np.einsum("ij,ij->i", colorDelta, colorDelta) <= DEDUP_COLOR_DISTANCE ** 2))
+                pairs.append(reps[queries[close]] * numTiles + reps[candidates[close]])
+    pairs = np.unique(np.concatenate(pairs)) if pairs else np.zeros(0, np.int64)
+
+    def find(index):
+        root = index
+        while parent[root] != root:
+            root = parent[root]
+        while parent[index] != root:
+            parent[index], index = root, parent[index]
+        return root
+    for i, j in zip(pairs // numTiles, pairs % numTiles):
+        rootI, rootJ = find(i), find(j)
+        if rootI != rootJ:
+            parent[max(rootI, rootJ)] = min(rootI, rootJ)
+    return np.array([find(index) for index in range(numTiles)], dtype=np.int64)
+
+def pack_to_tile_library(pack_dir, tiles, entries, metric_fct, tile_angles, jobs=None, dedup=None):
+    """ build the TileLibrary of a library pack
+        @param dedup Hamming distance of near-duplicate tile hashes (None: disabled),
+               only one representative of each near-duplicate cluster is kept """
+    angleMetrics = load_pack_metrics(pack_dir, tiles, metric_fct, tile_angles, jobs)
+    library = TileLibrary.fromPack(tiles, entries, angleMetrics, tile_angles)
+    if dedup is not None and len(tiles):
+        dedupPerf = PerfMetric("near-duplicate detection")
+        dedupPerf.start()
+        hashes, colors = load_pack_hashes(pack_dir, tiles)
+        representatives = near_duplicate_clusters(hashes, colors, dedup)
+        keep = representatives == np.arange(len(tiles))
+        dedupPerf.stop(len(tiles))
+        numPruned = len(tiles) - np.count_nonzero(keep)
+        PerfMetric.addCounter("near-duplicates pruned", numPruned)
+        print(f"near-duplicate detection: {numPruned} of {len(tiles)} image(s) pruned")
+        library = library.filter(keep[library.tileIds])
+    return library
+
+def sample_library(image_library, sampling):
+    """ select a random sub-sample of distinct tiles of the library (None: disabled) """
+    if sampling:
+        return image_library.sample(sampling)
+    else:
+        return image_library
+
 
+def pyramid_level(tile_dir, tileW, tileH):
+    """ find a library pack of tile_dir whose tiles are larger than (tileW x tileH),
+        tiles of another size can be derived from it by downscaling: the smallest
+        pack at least twice as large (limiting resampling blur) if any, else the
+        largest one
+        @return (tiles, entries) or None """
+    levels = []
+    if os.path.isdir(tile_dir):
+        for f in os.listdir(tile_dir):
+            levelMatch = re.fullmatch(r"pack_(?P<w>\d+)x(?P<h>\d+)", f)
+            if levelMatch:
+                w, h = int(levelMatch.group("w")), int(levelMatch.group("h"))
+                if w >= tileW and h >= tileH and (w, h) != (tileW, tileH):
+                    levels.append((w < 2 * tileW or h < 2 * tileH, (w * h) * (1 if w >= 2 * tileW and h >= 2 * tileH else -1), f))
+    for _, _, f in sorted(levels):
+        pack = open_library_pack(join(tile_dir, f))
+        if pack is not None:
+            return pack
+    return None
+
+def downscale_tiles(tiles, rows, tileW, tileH):
+    """ derive (tileW x tileH) thumbnails from the tiles at <rows> of a larger pyramid level """
+    PerfMetric.addCounter("thumbnails derived", len(rows))
+    return stack_tiles([cv2.resize(tiles[row], (tileW, tileH), interpolation=cv2.INTER_AREA) for row in rows], tileW, tileH)
+
+def update_library_pack(imgDir, tileDir, tileW, tileH, jobs=None, verbose=False, level=None, thumbFiles=True, blockSize=1024):
+    """ incrementally update the pack of (tileW x tileH) thumbnails of the images of imgDir
+        @param level (tiles, entries) pack of a larger pyramid level (None: disabled),
+               thumbnails of its up to date images are derived by downscaling instead
+               of decoding the images
+        @param thumbFiles also save (and re-use) thumbnails as image files in tileDir
+        @param blockSize number of tiles copied or derived at once
+        @return the updated pack (tiles, entries) """
+    pack_dir = get_pack_dir(tileDir, tileW, tileH)
+    pack = open_library_pack(pack_dir)
+    known = {}
+    if pack:
+        known = {entry["source"]: (row, entry) for (row, entry) in enumerate(pack[1]) if entry.get("source")}
+    levelKnown = {}
+    if level:
+        levelKnown = {entry["source"]: (row, entry) for (row, entry) in enumerate(level[1]) if entry.get("source")}
+    kept_rows = []
+    tasks = []
+    task_entries = []
+    derived_rows = []
+    derived_entries = []
+    thumbNames = collections.Counter()
+    for dirpath, dirnames, filenames in os.walk(imgDir):
+        for _f in filenames:
+            filename = os.path.abspath(os.path.join(dirpath, _f))
+            base = os.path.basename(filename)
+            prefix, extension = os.path.splitext(base)
+            extension = extension.lower()
+            thumb_filename = prefix + "_{}x{}".format(tileW, tileH) + extension
+            if extension in [".png", ".jpg"]:
+                # only png and jpg image are processed
+                thumbNames[thumb_filename] += 1
+                stat = os.stat(filename)
+                new_entry = {"thumb": thumb_filename, "source": filename, "size": stat.st_size, "mtime": stat.st_mtime_ns}
+                row, entry = known.get(filename, (None, None))
+                if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+                    if verbose: print("{} found in library pack".format(filename))
+                    kept_rows.append(row)
+                    continue
+                levelRow, levelEntry = levelKnown.get(filename, (None, None))
+                if levelEntry and levelEntry["size"] == stat.st_size and levelEntry["mtime"] == stat.st_mtime_ns:
+                    if verbose: print("{} derived from the thumbnail pyramid".format(filename))
+                    derived_rows.append(levelRow)
+                    derived_entries.append(new_entry)
+                    continue
+                if verbose: print("processing {}".format(filename))
+                tasks.append((filename, join(tileDir, thumb_filename) if thumbFiles else None, tileW, tileH))
+                task_entries.append(new_entry)
+    kept_rows.sort()
+    # thumbnail files are named after the image basename: a previously generated
+    # thumbnail is only re-used when migrating a library without pack (else the
+    # image is new or has been modified), and if no other image has the same basename
+    tasks = [task + (pack is None and thumbNames[task_entry["thumb"]] == 1,) for task, task_entry in zip(tasks, task_entries)]
+
+    writer = update_pack_writer(pack_dir, pack, kept_rows, tileW, tileH, blockSize)
+
+    decodePerf = PerfMetric(f"library thumbnails {tileW}x{tileH}")
+    decodePerf.start()
+    numDecoded = 0
+    for index, thumb in enumerate(parallel_map(make_thumbnail, tasks, jobs)):
+        if thumb is None:
+            print(f"[error] unable to process {tasks[index][0]}")
+        else:
+            writer.append(thumb[None], [task_entries[index]])
+            numDecoded += 1
+        if (index + 1) % 1000 == 0:
+            print(f"{index + 1} / {len(tasks)} image(s) processed")
+    decodePerf.stop(len(tasks))
+    PerfMetric.addCounter("images decoded", numDecoded)
+    PerfMetric.addCounter("library pack hits", len(kept_rows))
+    for start in range(0, len(derived_rows), blockSize):
+        writer.append(downscale_tiles(level[0], derived_rows[start:start + blockSize], tileW, tileH), derived_entries[start:start + blockSize])
+    print("{} new image(s) ({} derived from the thumbnail pyramid), {} image(s) already in library pack {}x{}".format(
+          numDecoded + len(derived_rows), len(derived_rows), len(kept_rows), tileW, tileH))
+    return writer.close()
 
 def build_image_library(cfg, metric_fct, tile_angles, verbose=False, sampling=None):
     """ build a library of thumbnails 
@@ -54,204 +686,885 @@ def build_image_library(cfg, metric_fct, tile_angles, verbose=False, sampling=No
         @param angles
         @sampling (None: disabled) select a sub-sample of the library
         
-        If a thumbnail has already been generated by a previous run, it will not be generated twice
+        The library is built incrementally: the pack manifest records the size and
+        modification time of each source image, only new or modified images are
+        decoded and resized (by a pool of cfg.jobs processes). Thumbnails generated
+        by a library without pack are re-used (if their basename is unique).
+
+        Thumbnails are cached as a pyramid: the pack of canonical
+        (cfg.pyramidSize x cfg.pyramidSize) thumbnails is updated first, smaller
+        tile sizes are derived from it by downscaling, without decoding images.
+        Larger tile sizes are derived from a larger cached pack if any. The pyramid
+        (and any derivation) is disabled if cfg.pyramidSize is 0
         """
     if not os.path.isdir(cfg.tileDir):
         print("creating directory {}".format(cfg.tileDir))
         os.mkdir(cfg.tileDir)
-    image_library = []
-    pixel_library = [f for f in os.listdir(cfg.tileDir) if isfile(join(cfg.tileDir, f))]
-    for dirpath, dirnames, filenames in os.walk(cfg.imgDir):
-        for _f in filenames:
-            filename = os.path.join(cfg.imgDir, dirpath, _f)
-            if verbose: print("processing {}".format(filename))
-            base = os.path.basename(filename)
-            prefix, extension = os.path.splitext(base)
-            extension = extension.lower()
-            thumb_filename = prefix + "_{}x{}".format(cfg.tileW, cfg.tileH) + extension
-            if extension in [".png", ".jpg"]:
-                # only png and jpg image are processed
-                if thumb_filename in pixel_library:
-                    # check if a file with name matching thumbnail filename already exists
-                    if verbose: print("pixel found in temporary library")
-                    thumb = cv2.imread(join(cfg.tileDir, thumb_filename))
-                else:
-                    if verbose: print("pixel NOT found in temporary library")
-                    try:
-                        picture = cv2.imread(filename)
-                        thumb = cv2.resize(picture, (cfg.tileW, cfg.tileH))
-                        # saving thumbnail
-                        cv2.imwrite(os.path.join(cfg.tileDir, thumb_filename), thumb)
-                    except:
-                        print(f"[error] unable to process {filename}")
-                for rot_angle in tile_angles:
-                    M = cv2.getRotationMatrix2D((cfg.tileW/2,cfg.tileH/2),rot_angle,1)
-                    new_tile = cv2.warpAffine(thumb,M,(cfg.tileW,cfg.tileH))
-                    metric = metric_fct(new_tile)
-                    image_library.append((metric, new_tile))
+    level = None
+    canonical = (cfg.tileW, cfg.tileH) == (cfg.pyramidSize, cfg.pyramidSize)
+    if cfg.pyramidSize and not canonical:
+        if cfg.tileW <= cfg.pyramidSize and cfg.tileH <= cfg.pyramidSize:
+            # canonical thumbnails are only stored in their pack
+            level = update_library_pack(cfg.imgDir, cfg.tileDir, cfg.pyramidSize, cfg.pyramidSize, cfg.jobs, verbose, thumbFiles=False)
+        else:
+            level = pyramid_level(cfg.tileDir, cfg.tileW, cfg.tileH)
+    pack_dir = get_pack_dir(cfg.tileDir, cfg.tileW, cfg.tileH)
+    tiles, entries = update_library_pack(cfg.imgDir, cfg.tileDir, cfg.tileW, cfg.tileH, cfg.jobs, verbose, level, thumbFiles=not canonical)
+    image_library = pack_to_tile_library(pack_dir, tiles, entries, metric_fct, tile_angles, cfg.jobs, cfg.dedup)
     print("library, containing {} image(s), has been generated".format(len(image_library)))
-    if sampling:
-        return random.choices(image_library, k=sampling)
-    else:
-        return image_library
+    return sample_library(image_library, sampling)
+
 
+def read_thumbnail(thumb_path):
+    """ read a thumbnail (library loader worker) """
+    return cv2.imread(thumb_path)
 
-def load_pixel_library(tile_dir, metric_fct, tile_angles, verbose=False, sampling=None):
+def list_thumbnails(tile_dir, tileW, tileH, verbose=False):
+    """ list the thumbnail files (<name>_<tileW>x<tileH>.<jpg|png>) of tile_dir
+        @return dict thumbnail filename -> (size, modification time) """
+    thumbs = {}
+    for dirEntry in os.scandir(tile_dir):
+        thumbMatch = re.match(r".*_(?P<w>\d+)x(?P<h>\d+).(jpg|JPG|PNG|png)", dirEntry.name)
+        if thumbMatch and dirEntry.is_file():
+            w = int(thumbMatch.group("w"))
+            h = int(thumbMatch.group("h"))
+            if w == tileW and h == tileH:
+                if verbose: print(f"pixel {dirEntry.name} with matching dimensions found in temporary library")
+                stat = dirEntry.stat()
+                thumbs[dirEntry.name] = (stat.st_size, stat.st_mtime_ns)
+    return thumbs
+
+def load_pixel_library(cfg, metric_fct, tile_angles, verbose=False, sampling=None):
     """ load a library of thumbnails 
-        @param tile_dir directory containing generated thumbnails
+        @param cfg configuration
         @param metric_fct
         @param angles
         @sampling (None: disabled) select a sub-sample of the library
         
-        If a thumbnail has already been generated by a previous run, it will not be generated twice
+        The library pack of cfg.tileDir is memory-mapped if it is up to date with
+        the thumbnails found in cfg.tileDir, else it is extended with new thumbnails
+        (or rebuilt if thumbnails have been removed or modified, according to their
+        size and modification time). If there is neither pack nor
+        thumbnail, the pack is derived from a larger level of the thumbnail pyramid
+        (unless cfg.pyramidSize is 0)
         """
+    tile_dir = cfg.tileDir
     if not os.path.isdir(tile_dir):
         raise Exception(f"{tile_dir} does not exist")
-    image_library = []
-    pixel_library = [f for f in os.listdir(tile_dir) if isfile(join(tile_dir, f))]
-    for thumb_filename in pixel_library:
-        thumbMatch = re.match(".*_(?P<w>\d+)x(?P<h>\d+).(jpg|JPG|PNG|png)", thumb_filename)
-        if thumbMatch:
-            w = int(thumbMatch.group("w"))
-            h = int(thumbMatch.group("h"))
-            if w == cfg.tileW and h == cfg.tileH:
-                if verbose: print(f"pixel {thumb_filename} with matching dimensions found in temporary library")
-                thumb = cv2.imread(join(tile_dir, thumb_filename))
-                for rot_angle in tile_angles:
-                    M = cv2.getRotationMatrix2D((cfg.tileW/2,cfg.tileH/2),rot_angle,1)
-                    new_tile = cv2.warpAffine(thumb,M,(cfg.tileW,cfg.tileH))
-                    metric = metric_fct(new_tile)
-                    image_library.append((metric, new_tile))
-    print("library, containing {} image(s), has been generated".format(len(image_library)))
-    if sampling:
-        return random.choices(image_library, k=sampling)
+    pack_dir = get_pack_dir(tile_dir, cfg.tileW, cfg.tileH)
+    pack = open_library_pack(pack_dir)
+    thumbs = list_thumbnails(tile_dir, cfg.tileW, cfg.tileH, verbose)
+    level = pyramid_level(tile_dir, cfg.tileW, cfg.tileH) if pack is None and not thumbs and cfg.pyramidSize else None
+    if pack is None and not thumbs and level is None:
+        raise Exception(f"no {cfg.tileW}x{cfg.tileH} thumbnail in {tile_dir}" + ("" if cfg.pyramidSize else " (pyramid derivation disabled)"))
+    if level:
+        # no thumbnail of the requested size: the pack is derived from a larger
+        # level of the thumbnail pyramid
+        tiles, levelEntries = level
+        print(f"deriving {len(levelEntries)} thumbnail(s) of {pack_dir} from {tiles.shape[2]}x{tiles.shape[1]} thumbnails")
+        entries = [dict(entry, thumb=re.sub(r"_\d+x\d+(\.\w+)$", f"_{cfg.tileW}x{cfg.tileH}\\1", entry["thumb"])) for entry in levelEntries]
+        writer = update_pack_writer(pack_dir, None, [], cfg.tileW, cfg.tileH)
+        for start in range(0, len(entries), 1024):
+            rows = range(start, min(start + 1024, len(entries)))
+            writer.append(downscale_tiles(tiles, rows, cfg.tileW, cfg.tileH), entries[start:start + 1024])
+        pack = writer.close()
     else:
-        return image_library
+        # tiles of library images (built by build_image_library) are kept, the
+        # ones of thumbnail files which have been removed or modified are dropped
+        def up_to_date(entry):
+            return entry.get("source") or (entry["thumb"] in thumbs and (entry.get("size"), entry.get("mtime")) == thumbs[entry["thumb"]])
+        kept_rows = [row for row, entry in enumerate(pack[1]) if up_to_date(entry)] if pack else []
+        packed = {pack[1][row]["thumb"] for row in kept_rows}
+        new_thumbs = [thumb for thumb in thumbs if thumb not in packed]
+        if pack is None or new_thumbs or len(kept_rows) != len(pack[1]):
+            print(f"packing {len(new_thumbs)} new or modified thumbnail(s) into {pack_dir} ({len(kept_rows)} already packed)")
+            writer = update_pack_writer(pack_dir, pack, kept_rows, cfg.tileW, cfg.tileH)
+            for thumb_filename, thumb in zip(new_thumbs, parallel_map(read_thumbnail, [join(tile_dir, thumb) for thumb in new_thumbs], cfg.jobs)):
+                if thumb is None or thumb.shape != (cfg.tileH, cfg.tileW, 3):
+                    print(f"[error] unable to read thumbnail {thumb_filename}")
+                else:
+                    size, mtime = thumbs[thumb_filename]
+                    writer.append(thumb[None], [{"thumb": thumb_filename, "source": None, "size": size, "mtime": mtime}])
+            PerfMetric.addCounter("images decoded", len(new_thumbs))
+            pack = writer.close()
+        elif verbose:
+            print(f"library pack {pack_dir} found")
+    tiles, entries = pack
+    image_library = pack_to_tile_library(pack_dir, tiles, entries, metric_fct, tile_angles, cfg.jobs, cfg.dedup)
+    print("library, containing {} image(s), has been generated".format(len(image_library)))
+    return sample_library(image_library, sampling)
+
+
+def closest_candidates(libMetrics, libNorms, used, chunk, numCandidates):
+    """ return the indices of the <numCandidates> closest available library metrics
+        of each row of chunk (at most the number of available tiles), sorted by
+        increasing distance, ties being broken by index """
+    available = len(used) - np.count_nonzero(used)
+    numCandidates = min(numCandidates, available)
+    if numCandidates == 0:
+        return np.zeros((len(chunk), 0), dtype=np.int64)
+    # squared distance minus |src|^2, which is constant for each source
+    # tile and does not change the ordering
+    dist = libNorms - 2 * (chunk @ libMetrics.T)
+    dist[:, used] = np.inf
+    # every tile within the float32 rounding error of the expanded distance of the
+    # k-th closest one is kept (ties included): candidates are then selected by
+    # their directly evaluated distance and index, which do not depend on the
+    # chunk layout or on the number of candidates
+    candidates = np.argpartition(dist, numCandidates - 1, axis=1)[:, :numCandidates]
+    kth = np.take_along_axis(dist, candidates, axis=1).max(axis=1)
+    margin = 8 * np.finfo(np.float32).eps * (libNorms.max() + np.einsum("ij,ij->i", chunk, chunk) + np.abs(kth))
+    within = dist <= (kth + margin)[:, None]
+    rows = np.repeat(np.arange(len(chunk)), numCandidates)
+    candidates = candidates.reshape(-1)
+    tied = np.flatnonzero(np.count_nonzero(within, axis=1) > numCandidates)
+    if len(tied):
+        # rows with ties (or near ties) at the cut: every tile within the margin is kept
+        keep = ~np.isin(rows, tied)
+        tiedRows, tiedCandidates = np.nonzero(within[tied])
+        rows = np.concatenate((rows[keep], tied[tiedRows]))
+        candidates = np.concatenate((candidates[keep], tiedCandidates))
+    delta = libMetrics[candidates].astype(np.float64) - chunk[rows]
+    exactDist = np.einsum("ij,ij->i", delta, delta)
+    order = np.lexsort((candidates, exactDist, rows))
+    rows, candidates = rows[order], candidates[order]
+    # first numCandidates entries of each row
+    rowStart = np.searchsorted(rows, np.arange(len(chunk)))
+    return candidates[rowStart[:, None] + np.arange(numCandidates)]
+
+# memory budget (bytes) of the distance matrices of exhaustive matching (split
+# between worker processes), and their size per (source, library tile) entry:
+# float32 distances and temporary, int64 partition indices, boolean mask
+MATCH_MEMORY_BUDGET = 256 * 2**20
+MATCH_ENTRY_BYTES = 24
+
+def match_chunk_size(numTiles, jobs=1, maxChunkSize=256):
+    """ number of source rows per distance matrix chunk, within the memory budget """
+    return int(max(1, min(maxChunkSize, MATCH_MEMORY_BUDGET // (jobs * MATCH_ENTRY_BYTES * max(numTiles, 1)))))
+
+class ExactMatcher:
+    """ exact closest tile selection: each source metric is matched with a tile
+        randomly chosen among the <random_size> closest available library tiles,
+        each library tile being used at most once.
+
+        Distances are evaluated as batched matrix products over chunks of source
+        metrics (None: as many rows as the memory budget allows), tile usage is
+        tracked with a boolean mask """
+    def __init__(self, libMetrics, random_size=6, chunkSize=None):
+        libMetrics = np.asarray(libMetrics, dtype=np.float32)
+        # centering metrics limits float32 cancellation in the expanded distance
+        self.center = libMetrics.mean(axis=0) if len(libMetrics) else 0
+        self.libMetrics = np.ascontiguousarray(libMetrics - self.center)
+        self.libNorms = np.einsum("ij,ij->i", self.libMetrics, self.libMetrics)
+        self.random_size = random_size
+        self.chunkSize = match_chunk_size(len(libMetrics)) if chunkSize is None else chunkSize
+        self.used = np.zeros(len(libMetrics), dtype=bool)
+
+    def fresh(self):
+        """ return a matcher sharing the library structures of self, with every
+            library tile available """
+        matcher = copy.copy(self)
+        matcher.used = np.zeros_like(self.used)
+        return matcher
+
+    @property
+    def numAvailable(self):
+        return len(self.used) - np.count_nonzero(self.used)
+
+    def claim(self, candidates, complete=True):
+        """ select (and mark as used), in order, a tile for each row of candidates
+            among its <random_size> closest available candidates.
+            Unless candidates are complete (each row lists every tile available
+            before the claim), selection stops at the first row left with less
+            than <random_size> available candidates
+            @return list of selected library tile indices """
+        selected = []
+        for rowCandidates in candidates:
+            closest_list = rowCandidates[~self.used[rowCandidates]][:self.random_size]
+            if len(closest_list) < self.random_size and not complete:
+                break
+            index = random.choice(closest_list)
+            self.used[index] = True
+            selected.append(index)
+        return selected
+
+    def match(self, srcMetrics):
+        """ select (and mark as used) a library tile for each source metric,
+            source metrics are processed in order
+            @return array of library tile indices """
+        srcMetrics = np.asarray(srcMetrics, dtype=np.float32).reshape(len(srcMetrics), self.center.size) - self.center
+        assert len(srcMetrics) <= self.numAvailable, f"there should more available tiles in the library ({self.numAvailable}) than the required number of tiles ({len(srcMetrics)})"
+        selected = np.empty(len(srcMetrics), dtype=np.int64)
+        for start in range(0, len(srcMetrics), self.chunkSize):
+            chunk = srcMetrics[start:start + self.chunkSize]
+            # each row needs its <random_size> closest tiles after the tiles
+            # picked by the previous rows of the chunk have been removed
+            candidates = closest_candidates(self.libMetrics, self.libNorms, self.used, chunk, self.random_size + len(chunk) - 1)
+            PerfMetric.addCounter("distance evaluations", len(chunk) * len(self.used))
+            selected[start:start + len(chunk)] = self.claim(candidates)
+        return selected
+
+class SharedArray:
+    """ numpy array stored in a named shared memory block (released when the
+        SharedArray object is garbage-collected) """
+    def __init__(self, array):
+        self.shape, self.dtype = array.shape, array.dtype
+        self.shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.array = np.ndarray(self.shape, self.dtype, buffer=self.shm.buf)
+        self.array[...] = array
+        weakref.finalize(self, SharedArray.release, self.shm)
+
+    @staticmethod
+    def release(shm):
+        shm.close()
+        shm.unlink()
+
+    @property
+    def descriptor(self):
+        """ picklable (name, shape, dtype) description of the shared array """
+        return self.shm.name, self.shape, self.dtype.str
+
+# shared library metrics of the parallel matcher worker processes
+worker_library = {}
+
+def attach_worker_library(descriptor):
+    """ parallel matcher worker initializer: attach the shared library metrics
+        (the last column being the metric squared norms) """
+    name, shape, dtype = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    worker_library["shm"] = shm
+    worker_library["metrics"] = np.ndarray(shape, dtype, buffer=shm.buf)
+
+def worker_candidates(task):
+    """ parallel matcher worker: closest candidates of a chunk of source metrics
+        @param task (chunk, packed used mask, numCandidates) """
+    chunk, usedBits, numCandidates = task
+    metrics = worker_library["metrics"]
+    used = np.unpackbits(usedBits, count=len(metrics)).astype(bool)
+    return closest_candidates(metrics[:, :-1], metrics[:, -1], used, chunk, numCandidates)
+
+class ParallelMatcher(ExactMatcher):
+    """ exact closest tile selection with candidate evaluation split across
+        <jobs> worker processes, the library metrics being shared through shared
+        memory.
+
+        Matching proceeds by optimistic rounds: the workers evaluate the closest
+        candidates of a window of source metrics against the tiles available at
+        the beginning of the round, then conflicts are resolved by claiming tiles
+        in source order (see ExactMatcher.claim). The round ends at the first
+        source metric whose candidates have been exhausted by previous claims,
+        the next round re-evaluating, with longer candidate lists, only the rows
+        following it up to the next expected conflict (the candidate lists of the
+        other rows being kept). The selection is identical to ExactMatcher's (for
+        the same random state), candidates being ranked by distance and index.
+
+        The worker pool lives as long as the matcher (and its fresh copies), its
+        processes being started on the first parallel match """
+    def __init__(self, libMetrics, random_size=6, chunkSize=None, jobs=None, extraCandidates=32):
+        jobs = os.cpu_count() if jobs is None else jobs
+        # each worker evaluates chunks within its share of the memory budget
+        ExactMatcher.__init__(self, libMetrics, random_size, match_chunk_size(len(libMetrics), jobs) if chunkSize is None else chunkSize)
+        self.jobs = jobs
+        self.extraCandidates = extraCandidates
+        self.shared = SharedArray(np.hstack([self.libMetrics, self.libNorms[:, None]]))
+        self.executor = ProcessPoolExecutor(self.jobs, initializer=attach_worker_library, initargs=(self.shared.descriptor,))
+
+    def match(self, srcMetrics):
+        """ select (and mark as used) a library tile for each source metric,
+            source metrics are processed in order
+            @return array of library tile indices """
+        if self.jobs <= 1 or len(srcMetrics) <= self.chunkSize:
+            return ExactMatcher.match(self, srcMetrics)
+        srcMetrics = np.asarray(srcMetrics, dtype=np.float32).reshape(len(srcMetrics), self.center.size) - self.center
+        assert len(srcMetrics) <= self.numAvailable, f"there should more available tiles in the library ({self.numAvailable}) than the required number of tiles ({len(srcMetrics)})"
+        selected = np.empty(len(srcMetrics), dtype=np.int64)
+        extra = self.extraCandidates
+        # candidate lists of the rows following start, evaluated in previous rounds:
+        # they remain valid (closest available tiles first) until exhausted
+        cached = []
+        numRows = self.jobs * self.chunkSize
+        start = 0
+        while start < len(srcMetrics):
+            numRows = min(numRows, len(srcMetrics) - start)
+            # random_size + numRows - 1 candidates can not be exhausted
+            numCandidates = min(self.random_size + extra, self.random_size + numRows - 1)
+            complete = numCandidates >= self.numAvailable
+            if complete:
+                # every remaining row is evaluated with every available tile
+                numRows = len(srcMetrics) - start
+                numCandidates = self.random_size + numRows - 1
+            block = srcMetrics[start:start + numRows]
+            usedBits = np.packbits(self.used)
+            taskSize = min(self.chunkSize, -(-numRows // self.jobs))
+            tasks = [(block[offset:offset + taskSize], usedBits, numCandidates) for offset in range(0, numRows, taskSize)]
+            cached = [rowCandidates for candidates in self.executor.map(worker_candidates, tasks) for rowCandidates in candidates] + cached[numRows:]
+            PerfMetric.addCounter("distance evaluations", numRows * len(self.used))
+            claimed = self.claim(cached, complete)
+            selected[start:start + len(claimed)] = claimed
+            start += len(claimed)
+            cached = cached[len(claimed):]
+            if cached:
+                # conflict: only the rows up to the next expected conflict are
+                # re-evaluated, with longer candidate lists
+                extra *= 2
+                numRows = max(self.jobs * 8, 2 * len(claimed))
+            else:
+                numRows = self.jobs * self.chunkSize
+        return selected
+
+class SpatialIndex:
+    """ nearest neighbour index over library metric vectors
+        removed tiles are tombstoned: they are ignored by subsequent queries
+        until the index is reset """
+    indexes = {}
+    def __init__(self, points):
+        self.points = np.ascontiguousarray(np.asarray(points, dtype=np.float32).reshape(len(points), -1))
+        self.alive = np.ones(len(self.points), dtype=bool)
+
+    def query(self, point, k):
+        """ return the indices of the (at most) k closest alive points, sorted by
+            increasing distance """
+        raise NotImplementedError
+
+    def queryBatch(self, points, k):
+        """ query the k closest alive points of each row of points
+            @return (indices, squared distances) arrays (len(points) x k), sorted by
+                    increasing distance and padded with -1 indices / inf distances """
+        indices = np.full((len(points), k), -1, dtype=np.int64)
+        sqDist = np.full((len(points), k), np.inf, dtype=np.float32)
+        for row, point in enumerate(np.asarray(points, dtype=np.float32).reshape(len(points), -1)):
+            closest = self.query(point, k)
+            indices[row, :len(closest)] = closest
+            delta = self.points[closest] - point
+            sqDist[row, :len(closest)] = np.einsum("ij,ij->i", delta, delta)
+        return indices, sqDist
+
+    def remove(self, index):
+        self.alive[index] = False
+
+    def fresh(self):
+        """ return an index sharing the structure of self, with every point alive """
+        index = copy.copy(self)
+        index.alive = np.ones_like(self.alive)
+        return index
+
+    def __len__(self):
+        return np.count_nonzero(self.alive)
+
+    @staticmethod
+    def RegisteredSpatialIndex(indexCls):
+        SpatialIndex.indexes[indexCls.label] = indexCls
+        return indexCls
+
+    def _closest(self, candidates, point, k):
+        """ return the k closest points among candidates, sorted by increasing distance """
+        delta = self.points[candidates] - point
+        dist = np.einsum("ij,ij->i", delta, delta)
+        PerfMetric.addCounter("distance evaluations", len(candidates))
+        if len(candidates) > k:
+            keep = np.argpartition(dist, k - 1)[:k]
+            candidates, dist = candidates[keep], dist[keep]
+        order = np.argsort(dist, kind="stable")
+        return candidates[order], dist[order]
+
+@SpatialIndex.RegisteredSpatialIndex
+class KDTreeIndex(SpatialIndex):
+    """ kd-tree with bounding boxes and per-node alive counters, queried best-first """
+    label = "kdtree"
+    def __init__(self, points, leafSize=32):
+        super().__init__(points)
+        self.order = np.arange(len(self.points))
+        self.nodeStart, self.nodeEnd = [], []
+        self.left, self.right, self.parent = [], [], []
+        lo, hi = [], []
+        def build(start, end, parent):
+            node = len(self.nodeStart)
+            nodePoints = self.points[self.order[start:end]]
+            self.nodeStart.append(start)
+            self.nodeEnd.append(end)
+            self.parent.append(parent)
+            self.left.append(-1)
+            self.right.append(-1)
+            lo.append(nodePoints.min(axis=0))
+            hi.append(nodePoints.max(axis=0))
+            if end - start > leafSize:
+                # splitting along the dimension with the largest spread
+                dim = np.argmax(hi[node] - lo[node])
+                mid = (start + end) // 2
+                sub = self.order[start:end]
+                self.order[start:end] = sub[np.argpartition(self.points[sub, dim], mid - start)]
+                self.left[node] = build(start, mid, node)
+                self.right[node] = build(mid, end, node)
+            return node
+        if len(self.points):
+            build(0, len(self.points), -1)
+        self.lo, self.hi = np.array(lo), np.array(hi)
+        self.initialCount = np.array(self.nodeEnd) - np.array(self.nodeStart)
+        self.aliveCount = self.initialCount.copy()
+        # leaf containing each point
+        self.leafOf = np.empty(len(self.points), dtype=np.int64)
+        for node, (start, end) in enumerate(zip(self.nodeStart, self.nodeEnd)):
+            if self.left[node] < 0:
+                self.leafOf[self.order[start:end]] = node
+
+    def remove(self, index):
+        if self.alive[index]:
+            self.alive[index] = False
+            node = self.leafOf[index]
+            while node >= 0:
+                self.aliveCount[node] -= 1
+                node = self.parent[node]
+
+    def fresh(self):
+        index = super().fresh()
+        index.aliveCount = self.initialCount.copy()
+        return index
+
+    def query(self, point, k):
+        point = np.asarray(point, dtype=np.float32).reshape(-1)
+        bestIdx = np.empty(0, dtype=np.int64)
+        bestDist = np.empty(0, dtype=np.float32)
+        worst = np.inf
+        if not len(self.nodeStart) or not self.aliveCount[0]:
+            return bestIdx
+        heap = [(0.0, 0)]
+        while heap:
+            bound, node = heapq.heappop(heap)
+            if bound > worst:
+                break
+            if self.left[node] < 0:
+                candidates = self.order[self.nodeStart[node]:self.nodeEnd[node]]
+                candidates = np.concatenate([bestIdx, candidates[self.alive[candidates]]])
+                bestIdx, bestDist = self._closest(candidates, point, k)
+                if len(bestIdx) == k:
+                    worst = bestDist[-1]
+            else:
+                for child in (self.left[node], self.right[node]):
+                    if self.aliveCount[child]:
+                        # lower bound of the distance between point and the child bounding box
+                        gap = np.maximum(0, np.maximum(self.lo[child] - point, point - self.hi[child]))
+                        childBound = float(gap @ gap)
+                        if childBound <= worst:
+                            heapq.heappush(heap, (childBound, child))
+        return bestIdx
+
+@SpatialIndex.RegisteredSpatialIndex
+class GridIndex(SpatialIndex):
+    """ uniform bucket grid over (at most) the 3 principal axes of the metric space,
+        queried by growing boxes of cells around the query cell """
+    label = "grid"
+    def __init__(self, points, bucketSize=16):
+        super().__init__(points)
+        self.mean = self.points.mean(axis=0) if len(self.points) else np.zeros(self.points.shape[1], np.float32)
+        centered = self.points - self.mean
+        if self.points.shape[1] > 3:
+            # projection on an orthonormal basis: projected distances are lower
+            # bounds of actual distances
+            self.axes = np.linalg.svd(centered, full_matrices=False)[2][:3].T
+        else:
+            self.axes = np.eye(self.points.shape[1], dtype=np.float32)
+        projected = centered @ self.axes
+        numDims = self.axes.shape[1]
+        self.gridSize = max(1, int(round((len(self.points) / bucketSize) ** (1 / numDims))))
+        self.gridShape = (self.gridSize,) * numDims
+        self.origin = projected.min(axis=0) if len(self.points) else np.zeros(numDims, np.float32)
+        span = projected.max(axis=0) - self.origin if len(self.points) else np.zeros(numDims, np.float32)
+        self.cellWidth = np.maximum(span, 1e-6) / self.gridSize
+        cellIds = np.ravel_multi_index(self._cellCoords(projected).T, self.gridShape)
+        self.order = np.argsort(cellIds, kind="stable")
+        self.cellStart = np.searchsorted(cellIds[self.order], np.arange(self.gridSize ** numDims + 1))
+
+    def _cellCoords(self, projected):
+        return np.clip(((projected - self.origin) / self.cellWidth).astype(np.int64), 0, self.gridSize - 1)
+
+    def _gather(self, cellLo, cellHi):
+        """ return the points of the cells in the box [cellLo, cellHi] """
+        ranges = np.meshgrid(*[np.arange(l, h + 1) for l, h in zip(cellLo, cellHi)], indexing="ij")
+        cellIds = np.ravel_multi_index([r.ravel() for r in ranges], self.gridShape)
+        starts = self.cellStart[cellIds]
+        counts = self.cellStart[cellIds + 1] - starts
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        return self.order[offsets]
+
+    def query(self, point, k):
+        point = np.asarray(point, dtype=np.float32).reshape(-1)
+        projected = (point - self.mean) @ self.axes
+        cell = self._cellCoords(projected)
+        radius = 0
+        while True:
+            cellLo = np.maximum(cell - radius, 0)
+            cellHi = np.minimum(cell + radius, self.gridSize - 1)
+            candidates = self._gather(cellLo, cellHi)
+            candidates = candidates[self.alive[candidates]]
+            complete = (cellLo == 0).all() and (cellHi == self.gridSize - 1).all()
+            if len(candidates) >= k or complete:
+                bestIdx, bestDist = self._closest(candidates, point, k)
+                if complete:
+                    return bestIdx
+                # points outside of the searched box are at least as far as the box boundary
+                boxLo = np.where(cellLo > 0, projected - (self.origin + cellLo * self.cellWidth), np.inf)
+                boxHi = np.where(cellHi < self.gridSize - 1, self.origin + (cellHi + 1) * self.cellWidth - projected, np.inf)
+                margin = max(0, min(boxLo.min(), boxHi.min()))
+                if bestDist[-1] <= margin ** 2:
+                    return bestIdx
+            radius += 1
+
+    def queryBatch(self, points, k):
+        # queries are grouped by grid cell: the candidates of a cell (the points of
+        # a box of cells around it, large enough to contain k alive points) are
+        # shared by all its queries. The result is approximate: it is exact when
+        # the k closest points of a query lie within the box
+        points = np.asarray(points, dtype=np.float32).reshape(len(points), -1)
+        indices = np.full((len(points), k), -1, dtype=np.int64)
+        sqDist = np.full((len(points), k), np.inf, dtype=np.float32)
+        cells = self._cellCoords((points - self.mean) @ self.axes)
+        cellIds = np.ravel_multi_index(cells.T, self.gridShape)
+        order = np.argsort(cellIds, kind="stable")
+        groupStart = np.flatnonzero(np.r_[True, cellIds[order][1:] != cellIds[order][:-1]])
+        for queries in np.split(order, groupStart[1:]):
+            cell = cells[queries[0]]
+            # a margin of one cell covers queries close to the cell boundary
+            radius = 1
+            while True:
+                cellLo = np.maximum(cell - radius, 0)
+                cellHi = np.minimum(cell + radius, self.gridSize - 1)
+                candidates = self._gather(cellLo, cellHi)
+                candidates = candidates[self.alive[candidates]]
+                if len(candidates) >= k or ((cellLo == 0).all() and (cellHi == self.gridSize - 1).all()):
+                    break
+                radius += 1
+            if not len(candidates):
+                continue
+            candidatePoints = self.points[candidates]
+            PerfMetric.addCounter("distance evaluations", len(queries) * len(candidates))
+            dist = (np.einsum("ij,ij->i", candidatePoints, candidatePoints)[None, :]
+                    - 2 * (points[queries] @ candidatePoints.T)
+                    + np.einsum("ij,ij->i", points[queries], points[queries])[:, None])
+            numClosest = min(k, len(candidates))
+            closest = np.argpartition(dist, numClosest - 1, axis=1)[:, :numClosest] if numClosest < len(candidates) else np.broadcast_to(np.arange(len(candidates)), dist.shape)
+            closestDist = np.take_along_axis(dist, closest, axis=1)
+            closestOrder = np.argsort(closestDist, axis=1)
+            indices[queries, :numClosest] = candidates[np.take_along_axis(closest, closestOrder, axis=1)]
+            sqDist[queries, :numClosest] = np.maximum(np.take_along_axis(closestDist, closestOrder, axis=1), 0)
+        return indices, sqDist
+
+class IndexMatcher:
+    """ closest tile selection through a spatial index: each source metric is matched
+        with a tile randomly chosen among the <random_size> closest available library
+        tiles, each library tile being used at most once """
+    def __init__(self, index, random_size=6):
+        self.index = index
+        self.random_size = random_size
+
+    def fresh(self):
+        """ return a matcher sharing the index structure of self, with every
+            library tile available """
+        return IndexMatcher(self.index.fresh(), self.random_size)
 
+    @property
+    def numAvailable(self):
+        return len(self.index)
+
+    def match(self, srcMetrics):
+        """ select (and remove from the index) a library tile for each source metric,
+            source metrics are processed in order
+            @return array of library tile indices """
+        assert len(srcMetrics) <= self.numAvailable, f"there should more available tiles in the library ({self.numAvailable}) than the required number of tiles ({len(srcMetrics)})"
+        selected = np.empty(len(srcMetrics), dtype=np.int64)
+        for row, metric in enumerate(srcMetrics):
+            closest_list = self.index.query(metric, self.random_size)
+            index = random.choice(closest_list)
+            self.index.remove(index)
+            selected[row] = index
+        return selected
+
+class MosaicTiles:
+    """ tile assignment of a mosaic: a (numTilesY x numTilesX) array of indices
+        in a stack of materialized (rotated) library tiles """
+    def __init__(self, assignment, tilePixels):
+        self.assignment = assignment
+        self.tilePixels = tilePixels
+
+    @property
+    def numTilesX(self):
+        return self.assignment.shape[1]
+
+    @property
+    def numTilesY(self):
+        return self.assignment.shape[0]
+
+    def compose(self, dest):
+        """ copy the mosaic tiles into dest, whose top-left part should be covered
+            by the tile grid """
+        tileH, tileW = self.tilePixels.shape[1:3]
+        grid = tile_grid_view(dest, tileW, tileH)
+        for tile_y in range(self.numTilesY):
+            grid[tile_y] = self.tilePixels[self.assignment[tile_y]]
+        return dest
+
+class GlobalMatcher:
+    """ global tile assignment: minimizes the total distance between source and
+        library metrics, each library tile being used at most <reuse> times.
+
+        The assignment problem is solved on a sparse graph connecting each source
+        metric to its <numCandidates> closest available library tiles (spatial
+        index batched queries) with a vectorized (Jacobi) forward auction algorithm,
+        epsilon being relative to the largest candidate cost. A source metric whose
+        candidates all get too expensive gives up and is reconsidered, with new
+        candidates (twice as many, up to <maxCandidates>), in the next pass; the
+        ones left after <numPasses> passes are greedily matched with their closest
+        available tile (batched sweeps) """
+    def __init__(self, index, reuse=1, numCandidates=16, maxCandidates=128, epsilon=1e-2, numPasses=8, maxRounds=10000):
+        self.index = index
+        self.reuse = reuse
+        self.numCandidates = numCandidates
+        self.maxCandidates = maxCandidates
+        self.epsilon = epsilon
+        self.numPasses = numPasses
+        self.maxRounds = maxRounds
+        self.remaining = np.full(len(index.points), reuse, dtype=np.int64)
+
+    def fresh(self):
+        """ return a matcher sharing the index structure of self, with every
+            library tile available """
+        return GlobalMatcher(self.index.fresh(), self.reuse, self.numCandidates, self.maxCandidates, self.epsilon, self.numPasses, self.maxRounds)
 
-def buildMosaicTiles(source, metric_fct, image_library, random_size=6, fast=False):
+    @property
+    def numAvailable(self):
+        return int(self.remaining.sum())
+
+    def auction(self, objects, cost, outsideCost):
+        """ solve the sparse min-cost assignment of rows to objects
+            @param objects (n x m) candidate object ids (-1: no candidate)
+            @param cost (n x m) candidate costs
+            @param outsideCost (n) cost above which a row stays unassigned
+            @return object assigned to each row (-1: unassigned) """
+        numRows = len(objects)
+        benefit = np.where(objects >= 0, -cost, -np.inf)
+        objects = np.maximum(objects, 0)
+        numObjects = objects.max() + 1 if objects.size else 0
+        # prices start at zero (and are never reset) so that objects left unassigned
+        # keep a null price: the result is then within numRows * eps of the optimum
+        prices = np.zeros(numObjects)
+        owner = np.full(numObjects, -1, dtype=np.int64)
+        assignment = np.full(numRows, -1, dtype=np.int64)
+        eps = max(float(np.max(cost, where=np.isfinite(cost), initial=0.0)), 1e-6) * self.epsilon
+        bidders = np.arange(numRows)
+        for _ in range(self.maxRounds):
+            values = benefit[bidders] - prices[objects[bidders]]
+            rows = np.arange(len(bidders))
+            best = np.argmax(values, axis=1)
+            bestValue = values[rows, best]
+            values[rows, best] = -np.inf
+            secondValue = np.maximum(values.max(axis=1), -outsideCost[bidders])
+            # rows preferring their outside option give up
+            bidding = bestValue >= -outsideCost[bidders]
+            bidders, best, bestValue, secondValue = bidders[bidding], best[bidding], bestValue[bidding], secondValue[bidding]
+            if not len(bidders):
+                break
+            bestObjects = objects[bidders, best]
+            bids = prices[bestObjects] + bestValue - secondValue + eps
+            # the highest bid wins each object, evicting its previous owner
+            order = np.lexsort((-bids, bestObjects))
+            first = np.r_[True, bestObjects[order][1:] != bestObjects[order][:-1]]
+            wonObjects, winners = bestObjects[order][first], bidders[order][first]
+            evicted = owner[wonObjects]
+            evicted = evicted[evicted >= 0]
+            assignment[evicted] = -1
+            owner[wonObjects] = winners
+            assignment[winners] = wonObjects
+            prices[wonObjects] = bids[order][first]
+            lost = np.ones(len(bidders), dtype=bool)
+            lost[order[first]] = False
+            bidders = np.concatenate((bidders[lost], evicted))
+        return assignment
+
+    def use(self, indices):
+        """ decrement the remaining capacity of library tiles, removing exhausted
+            ones from the index """
+        np.subtract.at(self.remaining, indices, 1)
+        for index in np.unique(indices):
+            if not self.remaining[index]:
+                self.index.remove(index)
+
+    def match(self, srcMetrics):
+        """ assign (and mark as used) a library tile to each source metric
+            @return array of library tile indices """
+        srcMetrics = np.asarray(srcMetrics, dtype=np.float32).reshape(len(srcMetrics), self.index.points.shape[1])
+        assert len(srcMetrics) <= self.numAvailable, f"there should more available tiles in the library ({self.numAvailable}) than the required number of tiles ({len(srcMetrics)})"
+        selected = np.full(len(srcMetrics), -1, dtype=np.int64)
+        pending = np.arange(len(srcMetrics))
+        slots = np.arange(self.reuse)
+        numCandidates = self.numCandidates
+        for _ in range(self.numPasses):
+            if not len(pending):
+                break
+            candidates, sqDist = self.index.queryBatch(srcMetrics[pending], numCandidates)
+            # each library tile provides <remaining> slots (objects of the auction)
+            valid = (candidates[..., None] >= 0) & (slots < self.remaining[np.maximum(candidates, 0)][..., None])
+            objects = np.where(valid, candidates[..., None] * self.reuse + slots, -1).reshape(len(pending), -1)
+            cost = np.repeat(np.sqrt(sqDist), self.reuse, axis=1)
+            # outside option: a tile beyond the candidates, at least as far as the
+            # farthest one. A higher outside cost only makes rows overbid for crowded
+            # tiles (long price wars on smooth sources) before giving up
+            outsideCost = np.max(cost, axis=1, where=np.isfinite(cost), initial=0.0)
+            assignment = self.auction(objects, cost, outsideCost)
+            assigned = assignment >= 0
+            selected[pending[assigned]] = assignment[assigned] // self.reuse
+            self.use(selected[pending[assigned]])
+            pending = pending[~assigned]
+            # rows left unassigned compete for crowded tiles: they get more
+            # candidates in the next pass
+            numCandidates = min(2 * numCandidates, self.maxCandidates)
+        while len(pending):
+            # greedy sweep: each row takes its closest candidate still available
+            candidates, _ = self.index.queryBatch(srcMetrics[pending], numCandidates)
+            remaining = self.remaining.copy()
+            for row, rowCandidates in zip(pending, candidates):
+                for index in rowCandidates[rowCandidates >= 0]:
+                    if remaining[index]:
+                        remaining[index] -= 1
+                        selected[row] = index
+                        break
+            served = selected[pending] >= 0
+            self.use(selected[pending[served]])
+            pending = pending[~served]
+        return selected
+
+def build_matcher(image_library, random_size=6, fast=False, index_label="kdtree", assignment="greedy", reuse=1, jobs=1):
+    """ build the closest tile matcher of a library: exhaustive search (split
+        across <jobs> worker processes, None: one per cpu) or, in fast mode,
+        through a spatial index of the library metrics.
+        The global assignment mode relies on a spatial index (grid by default) """
+    libMetrics = image_library.metrics
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if assignment == "global":
+        return GlobalMatcher(SpatialIndex.indexes[index_label if fast else "grid"](libMetrics), reuse)
+    elif fast:
+        return IndexMatcher(SpatialIndex.indexes[index_label](libMetrics), random_size)
+    elif jobs > 1:
+        return ParallelMatcher(libMetrics, random_size, jobs=jobs)
+    else:
+        return ExactMatcher(libMetrics, random_size)
+
+def select_tiles(cfg, image, metric_fct, image_library, matcher):
+    """ select (through matcher) a library tile for each tile of image
+        @return MosaicTiles """
+    # metrics of every image tile, evaluated in a single pass
+    with PerfMetric.span("source metrics"):
+        srcMetrics = grid_metrics(image, cfg.tileW, cfg.tileH, metric_fct)
+    numTilesY, numTilesX = srcMetrics.shape[:2]
+    PerfMetric.addCounter("source metric evaluations", numTilesY * numTilesX)
+    with PerfMetric.span("matching"):
+        selected = matcher.match(srcMetrics.reshape(numTilesY * numTilesX, srcMetrics.shape[2]))
+    # only selected tiles are materialized (and rotated)
+    with PerfMetric.span("tile materialization"):
+        used, assignment = np.unique(selected, return_inverse=True)
+        tilePixels = image_library.tilePixels(used)
+    PerfMetric.addCounter("tiles materialized", len(used))
+    return MosaicTiles(assignment.reshape(numTilesY, numTilesX), tilePixels)
+
+def buildMosaicTiles(source, metric_fct, image_library, random_size=6, fast=False, index_label="kdtree"):
     """ Building a mozaic approximating the source image """
     # iterating over 2D tiles of the source image. each tile is cfg.tileW x cfg.tileH
     #   - for each tile select the closest library thumbnail
     #   - build the destination image by replacing each source tile by the selected thumbnail
     #
-    # Two metrics are used:
-    # - the first metric, dist, is used to select the <random_size> closest thumbnail to the local tile
-
-    # metric linearization
-
-    # determing for the 3D metric (color) a max and a min vector
-    max_0 = max(m[0] for (m, t) in  image_library)
-    max_1 = max(m[1] for (m, t) in  image_library)
-    max_2 = max(m[2] for (m, t) in  image_library)
-    min_0 = min(m[0] for (m, t) in  image_library)
-    min_1 = min(m[1] for (m, t) in  image_library)
-    min_2 = min(m[2] for (m, t) in  image_library)
-
-    min_v = np.array([min_0, min_1, min_2])
-    max_v = np.array([max_0, max_1, max_2])
-    delta_v = max_v - min_v
-
-    numTilesReq = (source.height / cfg.tileH) * (source.width / cfg.tileW)
-    assert numTilesReq <= len(image_library), f"there should more tiles in the library ({len(image_library)} than the required number of tiles ({numTilesReq})"
-
-    def tileLinearizedMetric(metric):
-        # saturating the current vector metric between min and max value
-        saturatedMetric = np.maximum(np.minimum(metric, max_v), min_v)
-        # evaluating a scalar metric by normalizaing each component and generating a 3-digit number
-        scalarMetric = np.dot((saturatedMetric - min_v) / delta_v, np.array([1, 2, 4]))
-        return scalarMetric
-
-    linImgLib = sorted(image_library, key=lambda metric_tile: tileLinearizedMetric(metric_tile[0]))
-    linImgMetric = [tileLinearizedMetric(metric) for (metric, tile) in linImgLib]
-
-    def retrieveTile(index):
-        """ get and remove index-tile from library """
-        tile = linImgLib.pop(index)
-        linImgMetric.pop(index)
-        return tile
-
-    def getClosestTile(metric):
-        # using a median pivot to locate in logarithm time, <random_size> closest
-        # neighbours
-        imgMaxIdx = len(linImgLib) # this needs to be evaluated here (and not factorized) as the tile could have been updated
-        scalarMetric = tileLinearizedMetric(metric)
-        idx = imgMaxIdx // 2
-        idxSup = imgMaxIdx - 1
-        idxInf = 0
-        while idxSup - idxInf > random_size:
-            if linImgMetric[idx] < scalarMetric:
-                idxInf = idx 
-            else:
-                idxSup = idx
-            idx = idxInf + (idxSup - idxInf) // 2
-        idx = max(min(idx, imgMaxIdx - random_size // 2), random_size // 2)
-        return max(0, min(random.randrange(idx - random_size // 2, idx + random_size // 2), imgMaxIdx-1))
-
-    # retrieving the closest tile from each source tile
-    tiles = {}
-    for tile_y in range(source.height // cfg.tileH):
-        for tile_x in range(source.width // cfg.tileW):
-            x = tile_x * cfg.tileW
-            y = tile_y * cfg.tileH
-            local_thumb = source.data[y:(y+cfg.tileH), x:(x+cfg.tileW)]
-            src_average = metric_fct(local_thumb)
-            src_sub = sub_metric(local_thumb)
-            def dist(lib_img):
-                delta = src_average - lib_img[0]
-                value = np.dot(delta, delta.transpose())
-                # the actual distance should be math.sqrt(value) but since
-                # we compare 2 distances, we can save the square root evaluation
-                return value
-            def sub_dist(lib_img):
-                delta = src_sub - sub_metric(lib_img[1])
-                value = np.dot(delta, delta.transpose())
-                return math.sqrt(value)
-            if fast:
-                closestIdx = getClosestTile(src_average)
-                closest = retrieveTile(closestIdx)[1] # retrieving and removing tile from the list to ensure it is only used once
-            else:
-                enumeratedLib = list((m, img, idx) for (idx, (m, img)) in enumerate(image_library))
-                closest_list = sorted(enumeratedLib, key=dist)[:random_size]
-                imgTriple = random.choice(closest_list)
-                closest = imgTriple[1]
-                image_library.pop(imgTriple[2]) # remove (metric, closest) to ensure each tile is only used once
-            tiles[(tile_x, tile_y)] = closest
-    return tiles
+    # the <random_size> closest thumbnails are either found by an exhaustive (vectorized)
+    # search or, in fast mode, through a spatial index of the library metrics.
+    # In global assignment mode, the total distance of the whole mosaic is minimized
+
+    numTilesReq = (source.height // cfg.tileH) * (source.width // cfg.tileW)
+    matcher = build_matcher(image_library, random_size, fast, index_label, cfg.assignment, cfg.reuse, cfg.jobs)
+    assert numTilesReq <= matcher.numAvailable, f"there should more tiles in the library ({matcher.numAvailable}) than the required number of tiles ({numTilesReq})"
+
+    return select_tiles(cfg, source.data, metric_fct, image_library, matcher)
+
+def blend_mosaic(cfg, dest, tiles, sourceData):
+    """ compose tiles into dest and blend them in place with sourceData (both
+        images covering at least the tile grid) """
+    gridH, gridW = tiles.numTilesY * cfg.tileH, tiles.numTilesX * cfg.tileW
+    mosaic = dest[:gridH, :gridW]
+    tiles.compose(mosaic)
+    cv2.addWeighted(mosaic, cfg.mosaicCoeff, sourceData[:gridH, :gridW], cfg.sourceCoeff, 0, dst=mosaic)
+
+def stripe_columns(width, stripes):
+    """ return the list of (start, stop) columns of the black stripes """
+    columns = []
+    stripeWidth, nextStripe = stripes
+    for stripe in range(0, width, stripeWidth):
+        # p = stripe / source_width / 2
+        # black = random.random() > (1 - p) 
+        index = stripe // stripeWidth
+        black = index == nextStripe
+        if black:
+            columns.append((stripe, stripe + stripeWidth))
+            nextStripe = index + max(int(50 * (1.0 - (index / (width // stripeWidth))**2)), 2)
+    return columns
 
 def generateSingleImage(cfg, source, tiles, stripes=None):
-    # generate mosaic image
+    # generate mosaic image: tiles are gathered in the destination image,
+    # which is then blended in place with the source image
     dest = np.zeros((source.height, source.width, 3), np.uint8)
-    NUM_TILES_X = source.width // cfg.tileW
-    for tile_y in range(source.height // cfg.tileH):
-        y = tile_y * cfg.tileH
-        for tile_x in range(NUM_TILES_X):
-            x = tile_x * cfg.tileW
-            closest = tiles[(tile_x, tile_y)]
-            local_thumb = source.data[y:(y+cfg.tileH), x:(x+cfg.tileW)]
-            alphaThumb = 0.4
-            alphaSource = 1 - alphaThumb
-            dest[y:(y+cfg.tileH), x:(x+cfg.tileW)] = closest * alphaThumb + local_thumb * alphaSource
+    blend_mosaic(cfg, dest, tiles, source.data)
     # stripes
     addStripe = not stripes is None
     if addStripe:
-        stripeWidth, nextStripe = stripes
-        for stripe in range(0, source.width, stripeWidth):
-            # p = stripe / source_width / 2
-            # black = random.random() > (1 - p) 
-            index = stripe // stripeWidth
-            black = index == nextStripe
-            if black:
-                dest[0:source.height,stripe:stripe+stripeWidth] = 0
-                nextStripe = index + max(int(50 * (1.0 - (index / (source.width // stripeWidth))**2)), 2)
+        for start, stop in stripe_columns(source.width, stripes):
+            dest[0:source.height, start:stop] = 0
     
     return dest
 
+def generateStreamedImage(cfg, source, metric_fct, image_library, outputFileName, random_size=6, fast=False, index_label="kdtree", stripes=None, bandRows=16):
+    """ generate the mosaic image band by band: each band of <bandRows> tile rows of
+        the source is read, matched against the library (the use-once constraint
+        being shared by all bands), composed and written to a memory-mapped output.
+        Memory usage is bounded by the band height rather than by the image size """
+    numTilesX, numTilesY = source.width // cfg.tileW, source.height // cfg.tileH
+    matcher = build_matcher(image_library, random_size, fast, index_label, cfg.assignment, cfg.reuse, cfg.jobs)
+    assert numTilesX * numTilesY <= matcher.numAvailable, f"there should more tiles in the library ({matcher.numAvailable}) than the required number of tiles ({numTilesX * numTilesY})"
+    dest = create_image_memmap(outputFileName, source.width, source.height)
+    columns = stripe_columns(source.width, stripes) if stripes is not None else []
+    for bandStart in range(0, numTilesY, bandRows):
+        print(f"generating tile rows {bandStart} to {min(bandStart + bandRows, numTilesY) - 1}")
+        y0, y1 = bandStart * cfg.tileH, min(bandStart + bandRows, numTilesY) * cfg.tileH
+        sourceBand = np.ascontiguousarray(source.data[y0:y1])
+        tiles = select_tiles(cfg, sourceBand, metric_fct, image_library, matcher)
+        destBand = np.zeros(sourceBand.shape, np.uint8)
+        blend_mosaic(cfg, destBand, tiles, sourceBand)
+        for start, stop in columns:
+            destBand[:, start:stop] = 0
+        dest[y0:y1] = destBand
+    # rows below the tile grid (black) are left as initialized
+    del dest
+
 class AlphaGenerator:
+    """ generate the alpha value of library tiles for each frame of a video
+
+        Generators provide a whole alpha map per frame through getAlphaMap, the
+        default implementation relies on the per-tile getAlpha (which custom
+        generators may implement instead) """
     generators = {}
+    def __init__(self, cfg, videoCfg, sourceCfg, mosaicSplitDeltaFrames):
+        self.cfg = cfg
+        self.videoCfg = videoCfg
+        self.mosaicSplitDeltaFrames = mosaicSplitDeltaFrames
+        self.NUM_TILES_X = sourceCfg.width // cfg.tileW
+        self.NUM_TILES_Y = sourceCfg.height // cfg.tileH
+
+    def updateToFrame(self, frameId):
+        pass
+
     def getAlpha(self, frameId, tile_x, tile_y):
         raise NotImplementedError
 
+    def getAlphaMap(self, frameId):
+        """ return the (NUM_TILES_Y x NUM_TILES_X) float32 array of library tile alpha
+            values for frame <frameId> """
+        self.updateToFrame(frameId)
+        return np.array([[self.getAlpha(frameId, tile_x, tile_y) for tile_x in range(self.NUM_TILES_X)] for tile_y in range(self.NUM_TILES_Y)], dtype=np.float32)
+
     @staticmethod
     def RegisteredAlphaGenerator(genCls):
         AlphaGenerator.generators[genCls.label] = genCls 
@@ -261,10 +1574,10 @@ class AlphaGenerator:
 class WaveAlphaGenerator(AlphaGenerator):
     label = "wave"
     def __init__(self, cfg, videoCfg, sourceCfg, mosaicSplitDeltaFrames):
-        self.cfg = cfg
-        self.videoCfg = videoCfg
-        self.mosaicSplitDeltaFrames = mosaicSplitDeltaFrames
-        self.NUM_TILES_X = sourceCfg.width // cfg.tileW
+        super().__init__(cfg, videoCfg, sourceCfg, mosaicSplitDeltaFrames)
+        self.width = sourceCfg.width
+        # relative position of each tile column
+        self.columnX = np.arange(self.NUM_TILES_X) * cfg.tileW / self.width
 
     def updateToFrame(self, frameId):
         # number of frames between the time a column of tiles start to appear as mosaic
@@ -278,153 +1591,636 @@ class WaveAlphaGenerator(AlphaGenerator):
 
     def getAlpha(self, frameId, tile_x, tile_y):
         deltaAlpha = self.cfg.maxAlphaTile - self.cfg.minAlphaTile
-        x = tile_x * cfg.tileW
+        x = tile_x * self.cfg.tileW
         if tile_x < self.tileStartIdx:
             alphaThumb = self.cfg.minAlphaTile
         elif tile_x >= self.tileStopIdx:
             alphaThumb = self.cfg.maxAlphaTile
         else:
-            alphaThumb = self.cfg.minAlphaTile + (deltaAlpha) * max(0, min(1, (x / source.width - self.splitStartXRaw) / (self.mosaicSplitDeltaFrames / self.videoCfg.numFrames)))
+            alphaThumb = self.cfg.minAlphaTile + (deltaAlpha) * max(0, min(1, (x / self.width - self.splitStartXRaw) / (self.mosaicSplitDeltaFrames / self.videoCfg.numFrames)))
         return alphaThumb
 
+    def getAlphaMap(self, frameId):
+        self.updateToFrame(frameId)
+        deltaAlpha = self.cfg.maxAlphaTile - self.cfg.minAlphaTile
+        columnIdx = np.arange(self.NUM_TILES_X)
+        ramp = self.cfg.minAlphaTile + deltaAlpha * np.clip((self.columnX - self.splitStartXRaw) / (self.mosaicSplitDeltaFrames / self.videoCfg.numFrames), 0, 1)
+        columnAlpha = np.where(columnIdx < self.tileStartIdx, self.cfg.minAlphaTile,
+                               np.where(columnIdx >= self.tileStopIdx, self.cfg.maxAlphaTile, ramp))
+        return np.broadcast_to(columnAlpha.astype(np.float32), (self.NUM_TILES_Y, self.NUM_TILES_X))
+
 
 @AlphaGenerator.RegisteredAlphaGenerator
 class RandomAlphaGenerator(AlphaGenerator):
     label = "random"
     def __init__(self, cfg, videoCfg, sourceCfg, mosaicSplitDeltaFrames):
-        self.cfg = cfg
-        self.videoCfg = videoCfg
-        self.mosaicSplitDeltaFrames = mosaicSplitDeltaFrames
-        self.NUM_TILES_X = sourceCfg.width // cfg.tileW
-        self.NUM_TILES_Y = sourceCfg.height // cfg.tileH
+        super().__init__(cfg, videoCfg, sourceCfg, mosaicSplitDeltaFrames)
+        # numpy generator seeded from the random module state
+        rng = np.random.default_rng(random.getrandbits(64))
+        shape = (self.NUM_TILES_Y, self.NUM_TILES_X)
         maxStartFrame = (self.videoCfg.numFrames - mosaicSplitDeltaFrames)
-        self.startFrame         = [[int(random.random() * maxStartFrame) for i in range(self.NUM_TILES_Y)] for j in range(self.NUM_TILES_X)]
-        self.deltaAlphaPerFrame = [[1 / ((0.5 + 0.5 * random.random()) * mosaicSplitDeltaFrames) for i in range(self.NUM_TILES_Y)] for j in range(self.NUM_TILES_X)]
-
-    def updateToFrame(self, frameId):
-        pass
+        # state arrays are indexed by [tile_y, tile_x]
+        self.startFrame         = (rng.random(shape) * maxStartFrame).astype(np.int64)
+        self.deltaAlphaPerFrame = 1 / ((0.5 + 0.5 * rng.random(shape)) * mosaicSplitDeltaFrames)
 
     def getAlpha(self, frameId, tile_x, tile_y):
-        if frameId < self.startFrame[tile_x][tile_y]:
-            alphaThumb = self.cfg.minAlphaTile
-        else:
-            alphaOffset = (frameId - self.startFrame[tile_x][tile_y]) * self.deltaAlphaPerFrame[tile_x][tile_y]
-            alphaThumb = min(self.cfg.maxAlphaTile, self.cfg.minAlphaTile + (self.cfg.maxAlphaTile - self.cfg.minAlphaTile) * alphaOffset)
-        return alphaThumb
+        return float(self.alphaValues(frameId, self.startFrame[tile_y, tile_x], self.deltaAlphaPerFrame[tile_y, tile_x]))
+
+    def getAlphaMap(self, frameId):
+        return self.alphaValues(frameId, self.startFrame, self.deltaAlphaPerFrame).astype(np.float32)
+
+    def alphaValues(self, frameId, startFrame, deltaAlphaPerFrame):
+        alphaOffset = (frameId - startFrame) * deltaAlphaPerFrame
+        alphaThumb = np.minimum(self.cfg.maxAlphaTile, self.cfg.minAlphaTile + (self.cfg.maxAlphaTile - self.cfg.minAlphaTile) * alphaOffset)
+        return np.where(frameId < startFrame, self.cfg.minAlphaTile, alphaThumb)
     
 
 @AlphaGenerator.RegisteredAlphaGenerator
 class FireworksAlphaGenerator(RandomAlphaGenerator):
     label = "fireworks"
     def __init__(self, cfg, videoCfg, sourceCfg, mosaicSplitDeltaFrames):
-        self.cfg = cfg
-        self.videoCfg = videoCfg
-        self.mosaicSplitDeltaFrames = mosaicSplitDeltaFrames
-        self.NUM_TILES_X = sourceCfg.width // cfg.tileW
-        self.NUM_TILES_Y = sourceCfg.height // cfg.tileH
+        AlphaGenerator.__init__(self, cfg, videoCfg, sourceCfg, mosaicSplitDeltaFrames)
+        rng = np.random.default_rng(random.getrandbits(64))
         maxStartFrame = (self.videoCfg.numFrames - mosaicSplitDeltaFrames)
-        numCenters = random.randrange(10, 20)
-        centers = [(random.randrange(self.NUM_TILES_X), random.randrange(self.NUM_TILES_Y)) for i in range(numCenters)]
-        self.startFrame         = [[int(random.random() * maxStartFrame) for i in range(self.NUM_TILES_Y)] for j in range(self.NUM_TILES_X)]
-        self.deltaAlphaPerFrame = [[1 / ((0.5 + 0.5 * random.random()) * mosaicSplitDeltaFrames) for i in range(self.NUM_TILES_Y)] for j in range(self.NUM_TILES_X)]
-
-        for (cx, cy) in centers:
-            self.startFrame[cx][cy] = random.randrange(maxStartFrame)
-
-        for tile_x in range(self.NUM_TILES_X):
-            for tile_y in range(self.NUM_TILES_Y):
-                def distToCenter(center):
-                    (cx, cy) = center
-                    return (tile_x - cx)**2 + (tile_y - cy)**2
-                self.startFrame[tile_x][tile_y] = min(self.startFrame[cx][cy] + int(2 * math.sqrt((cx - tile_x)**2 + (cy - tile_y)**2)) for (cx, cy) in centers)
-                self.deltaAlphaPerFrame[tile_x][tile_y] = 1 / (0.5 * mosaicSplitDeltaFrames)
+        numCenters = rng.integers(10, 20)
+        centersX = rng.integers(self.NUM_TILES_X, size=numCenters)
+        centersY = rng.integers(self.NUM_TILES_Y, size=numCenters)
+        centersStart = rng.integers(maxStartFrame, size=numCenters)
+
+        # each tile starts when the wave of the closest (in time) center reaches it
+        tilesY, tilesX = np.mgrid[0:self.NUM_TILES_Y, 0:self.NUM_TILES_X]
+        distToCenters = np.sqrt((tilesX[..., None] - centersX)**2 + (tilesY[..., None] - centersY)**2)
+        self.startFrame = (centersStart + (2 * distToCenters).astype(np.int64)).min(axis=-1)
+        self.deltaAlphaPerFrame = np.full(self.startFrame.shape, 1 / (0.5 * mosaicSplitDeltaFrames))
+
+class FrameWriter:
+    """ write frames to a cv2.VideoWriter from a dedicated thread, through a bounded
+        queue (frames are written in submission order) """
+    def __init__(self, out, maxPending=8):
+        self.out = out
+        self.error = None
+        self.queue = queue.Queue(maxPending)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            if self.error is None:
+                try:
+                    # spans of the writer thread are not nested in the spans of the main thread
+                    with PerfMetric.span("video encoding"):
+                        self.out.write(frame)
+                    PerfMetric.addCounter("frames written")
+                except Exception as e:
+                    self.error = e
+
+    def write(self, frame):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(frame)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+class FrameRenderer:
+    """ render the frames of the source to mosaic transition from per-frame
+        tile alpha maps """
+    renderers = {}
+    def __init__(self, cfg, source, tiles, frameSize):
+        self.cfg = cfg
+        self.source = source
+        self.frameSize = frameSize
+        self.gridH, self.gridW = tiles.numTilesY * cfg.tileH, tiles.numTilesX * cfg.tileW
+        self.mosaic = tiles.compose(np.zeros((self.gridH, self.gridW, 3), np.uint8))
+
+    def frames(self, alphaMaps):
+        """ generate the (resized) frame of each alpha map, in order """
+        raise NotImplementedError
+
+    def frameReport(self, frameId):
+        """ return a short rendering cost report for frame <frameId> """
+        return ""
+
+    def summary(self):
+        """ return a rendering cost report for the whole video (or None) """
+        return None
+
+    @staticmethod
+    def RegisteredFrameRenderer(rendererCls):
+        FrameRenderer.renderers[rendererCls.label] = rendererCls
+        return rendererCls
+
+@FrameRenderer.RegisteredFrameRenderer
+class ParallelFrameRenderer(FrameRenderer):
+    """ every frame is fully composed (at source resolution) and resized by a pool of
+        threads, frames are reordered through a bounded queue of pending frames """
+    label = "parallel"
+    def __init__(self, cfg, source, tiles, frameSize):
+        super().__init__(cfg, source, tiles, frameSize)
+        # each frame is evaluated as source + alpha * (mosaic - source) over the tile grid,
+        # source and mosaic-source difference are evaluated once
+        self.sourceGrid = np.float32(source.data[:self.gridH, :self.gridW])
+        self.deltaGrid = np.float32(self.mosaic) - self.sourceGrid
+        self.numThreads = cfg.jobs or os.cpu_count()
+
+    def composeFrame(self, alphaMap):
+        """ compose (and resize) a frame from its alpha map, executed by render threads """
+        # upsampling tile alpha values to pixel alpha values (empty tile grid: source
+        # smaller than a tile)
+        if alphaMap.size:
+            alpha = cv2.resize(alphaMap, (self.gridW, self.gridH), interpolation=cv2.INTER_NEAREST)
+        else:
+            alpha = np.zeros((self.gridH, self.gridW), np.float32)
+        blended = self.deltaGrid * alpha[..., None]
+        blended += self.sourceGrid
+        frame = np.zeros((self.source.height, self.source.width, 3), np.uint8)
+        frame[:self.gridH, :self.gridW] = blended
+        return cv2.resize(frame, self.frameSize)
+
+    def frames(self, alphaMaps):
+        maxPending = 2 * self.numThreads
+        pending = collections.deque()
+        with ThreadPoolExecutor(self.numThreads) as executor:
+            for alphaMap in alphaMaps:
+                pending.append(executor.submit(self.composeFrame, np.array(alphaMap, dtype=np.float32)))
+                if len(pending) >= maxPending:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+@FrameRenderer.RegisteredFrameRenderer
+class IncrementalFrameRenderer(FrameRenderer):
+    """ keep a frame buffer at output resolution and only recompose the tiles
+        whose alpha value changed since the previous frame """
+    label = "incremental"
+    def __init__(self, cfg, source, tiles, frameSize):
+        super().__init__(cfg, source, tiles, frameSize)
+        w, h = frameSize
+        # source and mosaic are resized once to the output resolution
+        canvas = np.zeros((source.height, source.width, 3), np.uint8)
+        canvas[:self.gridH, :self.gridW] = source.data[:self.gridH, :self.gridW]
+        self.sourceOut = cv2.resize(canvas, frameSize)
+        canvas[:self.gridH, :self.gridW] = self.mosaic
+        self.mosaicOut = cv2.resize(canvas, frameSize)
+        # output pixel bounds of each tile column/row
+        self.colStart = (np.arange(tiles.numTilesX + 1) * cfg.tileW * w) // source.width
+        self.rowStart = (np.arange(tiles.numTilesY + 1) * cfg.tileH * h) // source.height
+        self.colTile = np.repeat(np.arange(tiles.numTilesX), np.diff(self.colStart))
+        self.buffer = np.zeros((h, w, 3), np.uint8)
+        self.dirtyFractions = []
+
+    def frames(self, alphaMaps):
+        prevAlpha = None
+        frame = None
+        for alphaMap in alphaMaps:
+            alphaMap = np.array(alphaMap, dtype=np.float32)
+            dirty = np.ones(alphaMap.shape, dtype=bool) if prevAlpha is None else alphaMap != prevAlpha
+            prevAlpha = alphaMap
+            self.dirtyFractions.append(dirty.mean() if dirty.size else 0.0)
+            if frame is None or dirty.any():
+                # recomposing the span of dirty tiles of each tile row
+                for tile_y in np.flatnonzero(dirty.any(axis=1)):
+                    dirtyX = np.flatnonzero(dirty[tile_y])
+                    x0, x1 = self.colStart[dirtyX[0]], self.colStart[dirtyX[-1] + 1]
+                    y0, y1 = self.rowStart[tile_y], self.rowStart[tile_y + 1]
+                    alpha = np.repeat(alphaMap[None, tile_y, self.colTile[x0:x1]], y1 - y0, axis=0)
+                    self.buffer[y0:y1, x0:x1] = cv2.blendLinear(self.mosaicOut[y0:y1, x0:x1], self.sourceOut[y0:y1, x0:x1], alpha, 1 - alpha)
+                # the buffer is copied as the previous frame may still be queued for writing
+                frame = self.buffer.copy()
+            yield frame
+
+    def frameReport(self, frameId):
+        return f" ({self.dirtyFractions[frameId]:.1%} dirty tiles)"
+
+    def summary(self):
+        if not self.dirtyFractions:
+            return None
+        fractions = np.array(self.dirtyFractions)
+        return f"dirty tiles: {fractions.mean():.1%} per frame on average, {np.count_nonzero(fractions == 0)} / {len(fractions)} frame(s) without any dirty tile"
 
 def generateVideo(cfg, videoCfg, source, tiles, w=1024, h=768, videoFileName="mosaic-video.avi", FPS=25):
     # recombing closest and source tiles with complementary alpha values
     frameSize = (w, h)
     out = cv2.VideoWriter(videoFileName, cv2.VideoWriter_fourcc(*'DIVX'), FPS, frameSize)
 
-    NUM_TILES_X = source.width // cfg.tileW
     mosaicSplitDeltaFrames = 40
 
     alphaGen = videoCfg.alphaGenClass(cfg, videoCfg, source, mosaicSplitDeltaFrames)
+    renderer = videoCfg.rendererClass(cfg, source, tiles, frameSize)
+
+    # alpha maps are generated in frame order, frames are encoded by a dedicated thread
+    def alphaMaps():
+        for i in range(videoCfg.numFrames):
+            with PerfMetric.span("alpha maps"):
+                alphaMap = alphaGen.getAlphaMap(i)
+            yield alphaMap
+    writer = FrameWriter(out)
+    try:
+        for i, img in enumerate(renderer.frames(alphaMaps())):
+            print(f"generating frame {i}" + renderer.frameReport(i))
+            writer.write(img)
+
+        # extra (still) frames repeat the last frame
+        for j in range(videoCfg.extraFrames):
+            writer.write(img)
+    finally:
+        writer.close()
+        out.release()
+    report = renderer.summary()
+    if report:
+        print(report)
+
+
+class MosaicService:
+    """ keep a library, its metric matrix and its matcher (spatial index) resident
+        to generate the mosaics of successive jobs (batch and server modes).
+        Each job starts from a fresh copy of the tile availability state.
+
+        A job is a dict with the following keys:
+        - source, output: source and destination filenames
+        - mode (optional): "image" (default) or "video"
+        - random_size, stripes (optional)
+        - num_frames, extra_frames, alpha_gen, renderer, size (optional, video mode) """
+    def __init__(self, cfg, metric_fct, image_library, random_size=6, fast=False, index_label="kdtree"):
+        self.cfg = cfg
+        self.metric_fct = metric_fct
+        self.image_library = image_library
+        self.matcher = build_matcher(image_library, random_size, fast, index_label, cfg.assignment, cfg.reuse, cfg.jobs)
 
-    # building source tile array
-    sourceTiles = {}
-    for tile_x in range(NUM_TILES_X):
-        x = tile_x * cfg.tileW
-        for tile_y in range(source.height // cfg.tileH):
-            y = tile_y * cfg.tileH
-            local_thumb = source.data[y:(y+cfg.tileH), x:(x+cfg.tileW)]
-            sourceTiles[(tile_x, tile_y)] = local_thumb
-
-    for i in range(videoCfg.numFrames):
-        # generating empty image for destination
-        print(f"generating frame {i}")
-        frame = np.zeros((source.height, source.width, 3), np.uint8)
-        alphaGen.updateToFrame(i)
-        for tile_x in range(NUM_TILES_X):
-            x = tile_x * cfg.tileW
-            for tile_y in range(source.height // cfg.tileH):
-                alphaThumb = alphaGen.getAlpha(i, tile_x, tile_y)
-                alphaSource = 1 - alphaThumb
-                y = tile_y * cfg.tileH
-                closest = tiles[(tile_x, tile_y)]
-                local_thumb = sourceTiles[(tile_x, tile_y)]
-                if alphaThumb == 0:
-                    frame[y:(y+cfg.tileH), x:(x+cfg.tileW)] = local_thumb
-                elif alphaThumb == 1.0:
-                    frame[y:(y+cfg.tileH), x:(x+cfg.tileW)] = closest
-                else:
-                    frame[y:(y+cfg.tileH), x:(x+cfg.tileW)] = closest * alphaThumb + local_thumb * alphaSource
-        img = cv2.resize(frame, frameSize)
-        out.write(img)
-
-    for j in range(videoCfg.extraFrames):
-        out.write(img)
+    @staticmethod
+    def checkJob(job):
+        """ raise a ValueError if job is not a valid job """
+        if not isinstance(job, dict):
+            raise ValueError("a job must be a json object")
+        missing = [key for key in ("source", "output") if key not in job]
+        if missing:
+            raise ValueError(f"missing job key(s): {', '.join(missing)}")
+
+    def run(self, job):
+        """ execute a job, return a report dict """
+        self.checkJob(job)
+        startTS = time.perf_counter()
+        source = Source(job["source"])
+        decodeTS = time.perf_counter()
+        matcher = self.matcher.fresh()
+        if "random_size" in job:
+            matcher.random_size = job["random_size"]
+        numTilesReq = (source.height // self.cfg.tileH) * (source.width // self.cfg.tileW)
+        assert numTilesReq <= matcher.numAvailable, f"there should more tiles in the library ({matcher.numAvailable}) than the required number of tiles ({numTilesReq})"
+        tiles = select_tiles(self.cfg, source.data, self.metric_fct, self.image_library, matcher)
+        matchTS = time.perf_counter()
+        mode = job.get("mode", "image")
+        if mode == "video":
+            videoCfg = VideoConfiguration(job.get("num_frames", 250), job.get("extra_frames", 250),
+                                          job.get("alpha_gen", "random"), job.get("renderer", "incremental"))
+            frameW, frameH = job.get("size", (1024, 768))
+            generateVideo(self.cfg, videoCfg, source, tiles, frameW, frameH, videoFileName=job["output"])
+        elif mode == "image":
+            dest = generateSingleImage(self.cfg, source, tiles, job.get("stripes"))
+            cv2.imwrite(job["output"], dest)
+        else:
+            raise Exception(f"unknown job mode {mode}")
+        stopTS = time.perf_counter()
+        return {"source": job["source"], "output": job["output"], "mode": mode,
+                "decoding": decodeTS - startTS, "matching": matchTS - decodeTS, "output_generation": stopTS - matchTS}
+
+def run_batch(service, jobs):
+    """ execute a list of jobs with a warm service, failing jobs are reported and skipped
+        @return list of job reports """
+    reports = []
+    for job in jobs:
+        try:
+            report = service.run(job)
+        except Exception as e:
+            report = {"source": job.get("source") if isinstance(job, dict) else None, "error": str(e)}
+        print(json.dumps(report))
+        reports.append(report)
+    return reports
+
+def serve(service, host="127.0.0.1", port=8765):
+    """ serve mosaic jobs over local HTTP: a POST request body is a json job,
+        the response is the json job report; GET returns the service status """
+    class MosaicRequestHandler(BaseHTTPRequestHandler):
+        def sendJson(self, code, content):
+            body = json.dumps(content).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.sendJson(200, {"library": len(service.image_library)})
+
+        def do_POST(self):
+            try:
+                job = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                service.checkJob(job)
+            except ValueError as e:
+                self.sendJson(400, {"error": f"invalid job: {e}"})
+                return
+            try:
+                self.sendJson(200, service.run(job))
+            except Exception as e:
+                self.sendJson(500, {"source": job.get("source"), "error": str(e)})
+
+    server = ThreadingHTTPServer((host, port), MosaicRequestHandler)
+    print(f"serving mosaic jobs on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
-    out.release()
 
+def peak_rss():
+    """ return the peak resident set size (kB) of the process and of its (waited
+        for) worker processes, None if unavailable """
+    if resource is None:
+        return None, None
+    # ru_maxrss is expressed in bytes on macOS, in kB elsewhere
+    scale = 1024 if sys.platform == "darwin" else 1
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale)
 
 class PerfMetric:
+    """ timed span: a span started while another one is active (in the same
+        thread) is nested in it. Spans can be started and stopped several times,
+        possibly concurrently by several threads (serve mode jobs): start times are
+        kept per thread, elapsed times and item counts are accumulated.
+
+        Class-level counters record the number of items processed by each stage
+        (images decoded, metric evaluations, distance evaluations, cache hits,
+        frames written...) """
     metricList = []
-
-    def __init__(self, label):
+    counters = collections.Counter()
+    lock = threading.Lock()
+    activeSpans = threading.local()
+    # optional cProfile/tracemalloc hook
+    hook = None
+    hookResults = None
+
+    def __init__(self, label, parent=None):
         self.label = label
-        self.startTS = None
-        self.stopTS  = None
-        PerfMetric.metricList.append(self)
+        self.parent = parent
+        # start time of the span in each thread (thread id -> time)
+        self.startTS = {}
+        self.count   = None
+        self.elapsed = 0.0
+        self.calls   = 0
+        # peak RSS of the whole process (not of the span) when the span was last stopped
+        self.processPeakRSS = None
+        with PerfMetric.lock:
+            PerfMetric.metricList.append(self)
+
+    @staticmethod
+    def activeStack():
+        if not hasattr(PerfMetric.activeSpans, "stack"):
+            PerfMetric.activeSpans.stack = []
+        return PerfMetric.activeSpans.stack
+
+    @staticmethod
+    def span(label):
+        """ return the span <label> nested in the active span (created on first
+            use), to be used as a context manager """
+        stack = PerfMetric.activeStack()
+        parent = stack[-1] if stack else None
+        with PerfMetric.lock:
+            for metric in PerfMetric.metricList:
+                if metric.label == label and metric.parent is parent:
+                    return metric
+        return PerfMetric(label, parent)
+
+    @staticmethod
+    def addCounter(name, value=1):
+        with PerfMetric.lock:
+            PerfMetric.counters[name] += value
 
     def start(self):
-        self.startTS = time.perf_counter()
-    def stop(self):
-        self.stopTS = time.perf_counter()
+        stack = PerfMetric.activeStack()
+        if self.parent is None and stack and stack[-1] is not self:
+            self.parent = stack[-1]
+        stack.append(self)
+        with PerfMetric.lock:
+            self.startTS[threading.get_ident()] = time.perf_counter()
+    def stop(self, count=None):
+        """ stop the timer (started by the same thread), count is the (optional)
+            number of processed items """
+        stopTS = time.perf_counter()
+        processPeakRSS = peak_rss()[0]
+        with PerfMetric.lock:
+            self.elapsed += stopTS - self.startTS.pop(threading.get_ident())
+            self.calls += 1
+            if count is not None:
+                self.count = (self.count or 0) + count
+            self.processPeakRSS = processPeakRSS
+        stack = PerfMetric.activeStack()
+        if self in stack:
+            stack.remove(self)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    @property
+    def depth(self):
+        return 0 if self.parent is None else self.parent.depth + 1
+
+    @staticmethod
+    def spans():
+        """ list the spans which have been stopped at least once, each span being
+            followed by its nested spans """
+        children = collections.defaultdict(list)
+        for metric in PerfMetric.metricList:
+            if metric.calls:
+                children[metric.parent].append(metric)
+        def walk(parent):
+            for metric in children[parent]:
+                yield metric
+                yield from walk(metric)
+        return list(walk(None))
 
     def summary(self):
-        return f"{self.label:20} executed in {self.stopTS - self.startTS:.3} second(s)"
+        elapsed = self.elapsed
+        summary = f"{'  ' * self.depth + self.label:20} executed in {elapsed:.3} second(s)"
+        if self.calls > 1:
+            summary += f" ({self.calls} calls)"
+        if self.count is not None:
+            summary += f", {self.count} item(s) ({self.count / max(elapsed, 1e-9):.1f} item(s)/s)"
+        return summary
+
+    @staticmethod
+    def startHook(hook):
+        """ start a cProfile ("cprofile") or tracemalloc ("tracemalloc") hook """
+        if hook == "cprofile":
+            PerfMetric.hook = cProfile.Profile()
+            PerfMetric.hook.enable()
+        elif hook == "tracemalloc":
+            tracemalloc.start()
+            PerfMetric.hook = tracemalloc
+        else:
+            raise Exception(f"unknown profiling hook {hook}")
+
+    @staticmethod
+    def stopHook(top=20):
+        """ stop the profiling hook and record its <top> entries: functions with the
+            largest cumulative time or allocation sites with the largest size """
+        if isinstance(PerfMetric.hook, cProfile.Profile):
+            PerfMetric.hook.disable()
+            stats = pstats.Stats(PerfMetric.hook).stats
+            entries = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+            PerfMetric.hookResults = {"hook": "cprofile", "entries": [
+                {"location": f"{filename}:{line}({function})", "calls": calls, "tottime": tottime, "cumtime": cumtime}
+                for (filename, line, function), (_, calls, tottime, cumtime, _) in entries]}
+        elif PerfMetric.hook is tracemalloc:
+            current, peak = tracemalloc.get_traced_memory()
+            statistics = tracemalloc.take_snapshot().statistics("lineno")[:top]
+            tracemalloc.stop()
+            PerfMetric.hookResults = {"hook": "tracemalloc", "current_kb": current // 1024, "peak_kb": peak // 1024, "entries": [
+                {"location": str(stat.traceback), "size_kb": stat.size // 1024, "count": stat.count} for stat in statistics]}
+        PerfMetric.hook = None
+
+    @staticmethod
+    def report():
+        """ return the performance report (spans, counters, peak memory, hook results) as a dict """
+        spans = PerfMetric.spans()
+        selfRSS, childrenRSS = peak_rss()
+        return {
+            "spans": [{"label": metric.label, "parent": spans.index(metric.parent) if metric.parent else None,
+                       "depth": metric.depth, "elapsed": metric.elapsed, "calls": metric.calls,
+                       "count": metric.count, "process_peak_rss_kb": metric.processPeakRSS} for metric in spans],
+            "counters": dict(PerfMetric.counters),
+            "peak_rss_kb": selfRSS,
+            "peak_children_rss_kb": childrenRSS,
+            "hook": PerfMetric.hookResults,
+        }
+
+    @staticmethod
+    def exportReport(filename):
+        """ export the performance report as JSON or, for .csv filenames, as CSV
+            rows (kind, label, parent, depth, elapsed, calls, count, value), the value
+            of a span being the process peak RSS when it was last stopped """
+        report = PerfMetric.report()
+        if os.path.splitext(filename)[1].lower() != ".csv":
+            with open(filename, "w") as stream:
+                json.dump(report, stream, indent=2)
+            return
+        with open(filename, "w", newline="") as stream:
+            writer = csv.writer(stream)
+            writer.writerow(["kind", "label", "parent", "depth", "elapsed", "calls", "count", "value"])
+            for span in report["spans"]:
+                writer.writerow(["span", span["label"], span["parent"], span["depth"], span["elapsed"], span["calls"], span["count"], span["process_peak_rss_kb"]])
+            for name, value in report["counters"].items():
+                writer.writerow(["counter", name, "", "", "", "", "", value])
+            writer.writerow(["memory", "peak_rss_kb", "", "", "", "", "", report["peak_rss_kb"]])
+            writer.writerow(["memory", "peak_children_rss_kb", "", "", "", "", "", report["peak_children_rss_kb"]])
+            if report["hook"]:
+                for entry in report["hook"]["entries"]:
+                    if report["hook"]["hook"] == "cprofile":
+                        writer.writerow(["cprofile", entry["location"], "", "", entry["cumtime"], entry["calls"], "", entry["tottime"]])
+                    else:
+                        writer.writerow(["tracemalloc", entry["location"], "", "", "", "", entry["count"], entry["size_kb"]])
 
 class Configuration:
     """ structure to store run configuration, including:
         - tile dimensions """
-    def __init__(self, tileSize, imgDir, tileDir, minAlphaTile=0, maxAlphaTile=1):
+    def __init__(self, tileSize, imgDir, tileDir, minAlphaTile=0, maxAlphaTile=1, jobs=None, sourceCoeff=0.25, mosaicCoeff=0.75,
+                 assignment="greedy", reuse=1, pyramidSize=128, dedup=None):
         self.tileW, self.tileH = tileSize
         self.imgDir = imgDir
         self.tileDir = tileDir
         self.minAlphaTile = minAlphaTile
         self.maxAlphaTile = maxAlphaTile
+        # number of worker processes/threads (None: one per cpu)
+        self.jobs = jobs
+        # blending coefficients of the still image output
+        self.sourceCoeff = sourceCoeff
+        self.mosaicCoeff = mosaicCoeff
+        # tile assignment: "greedy" (source tile by source tile) or "global",
+        # each library tile being used at most <reuse> times in global mode
+        self.assignment = assignment
+        self.reuse = reuse
+        # size of the canonical thumbnails of the pyramid cache (0: disabled)
+        self.pyramidSize = pyramidSize
+        # Hamming distance of near-duplicate library tiles (None: no deduplication)
+        self.dedup = dedup
 
 class VideoConfiguration:
     """ Video-specific configuration """
-    def __init__(self, numFrames, extraFrames, alphaGenLabel):
+    def __init__(self, numFrames, extraFrames, alphaGenLabel, rendererLabel="incremental"):
         self.numFrames = numFrames
         self.extraFrames = extraFrames
         self.alphaGenClass = AlphaGenerator.generators[alphaGenLabel]
+        self.rendererClass = FrameRenderer.renderers[rendererLabel]
+
+def open_image_memmap(filename):
+    """ memory-map an uncompressed image: binary PPM (P6) or .npy (BGR) array
+        @return a (height x width x 3) BGR view of the image or None if the image
+                format can not be memory-mapped """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".npy":
+        return np.load(filename, mmap_mode="r")
+    elif extension in [".ppm", ".pnm"]:
+        with open(filename, "rb") as stream:
+            header = stream.read(1024)
+        # header: P6 <width> <height> <maxval> (with optional comments) and a single whitespace
+        fields, offset = [], 0
+        while len(fields) < 4:
+            while header[offset:offset + 1].isspace():
+                offset += 1
+            if header[offset:offset + 1] == b"#":
+                offset = header.index(b"\n", offset)
+                continue
+            end = offset
+            while not header[end:end + 1].isspace():
+                end += 1
+            fields.append(header[offset:end])
+            offset = end
+        if fields[0] != b"P6" or int(fields[3]) != 255:
+            return None
+        width, height = int(fields[1]), int(fields[2])
+        data = np.memmap(filename, dtype=np.uint8, mode="r", offset=offset + 1, shape=(height, width, 3))
+        # PPM pixels are stored as RGB
+        return data[:, :, ::-1]
+    return None
+
+def create_image_memmap(filename, width, height):
+    """ create a zero-filled memory-mapped image: binary PPM (P6) or .npy (BGR) array
+        @return a writable (height x width x 3) BGR view of the image """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".npy":
+        return np.lib.format.open_memmap(filename, mode="w+", dtype=np.uint8, shape=(height, width, 3))
+    elif extension in [".ppm", ".pnm"]:
+        header = "P6\n{} {}\n255\n".format(width, height).encode()
+        with open(filename, "wb") as stream:
+            stream.write(header)
+            stream.truncate(len(header) + width * height * 3)
+        data = np.memmap(filename, dtype=np.uint8, mode="r+", offset=len(header), shape=(height, width, 3))
+        return data[:, :, ::-1]
+    raise Exception(f"streamed output {filename} should be a .ppm or .npy image")
 
 class Source:
     """ structure to store source data and metadata """
-    def __init__(self, sourceFilename):
-        print("reading source image")
-        self.data = cv2.imread(sourceFilename)
+    def __init__(self, sourceFilename, mmap=False):
+        """ if mmap is set, uncompressed sources (PPM, npy) are memory-mapped
+            instead of being loaded in memory """
+        self.data = open_image_memmap(sourceFilename) if mmap else None
+        if self.data is None:
+            if mmap: print(f"[warning] {sourceFilename} can not be memory-mapped, it is fully loaded")
+            print("reading source image")
+            self.data = cv2.imread(sourceFilename)
+            if self.data is None:
+                raise Exception(f"unable to read source image {sourceFilename}")
         self.sourceSize = (self.data.shape[1], self.data.shape[0])
 
     @property
@@ -440,7 +2236,10 @@ if __name__ == "__main__":
     parser.add_argument('--library', default=None, type=str, help='path to pixel library')
     parser.add_argument("--tile-dir", default="./.mosaic_libs/", type=str, help="directory to save pixel thumbnails")
     parser.add_argument('--source', type=str, help='path to source image')
-    parser.add_argument('--fast', default=False, const=True, action="store_const", help="accelerate closest tile selection with fast and less accurate method")
+    parser.add_argument('--fast', default=False, const=True, action="store_const", help="accelerate closest tile selection with a spatial index of the library")
+    parser.add_argument('--index', default="kdtree", type=str, choices=SpatialIndex.indexes.keys(), help="spatial index used by --fast closest tile selection")
+    parser.add_argument('--assignment', default="greedy", type=str, choices=["greedy", "global"], help="tile assignment: greedy (random choice among the closest available tiles) or global (minimal total distance)")
+    parser.add_argument('--reuse', default=1, type=int, help="maximal number of uses of each library tile in global assignment mode")
     parser.add_argument('--metric', default=average_metric, type=parse_metric, help='set metric to determine closest thumbnail')
     parser.add_argument("--tile-size", default=(32, 32), type=parse_int_tuple, help='set thumbnail size')
     parser.add_argument("--random-size", default=6, type=int, help='size of the closest pixel set to chose from')
@@ -448,15 +2247,22 @@ if __name__ == "__main__":
     parser.add_argument("--mosaic-coeff", default=0.75, type=float, help='coefficient of generated mosaic image in final output blending')
     parser.add_argument("--tile-angles", default=[0], type=(lambda s: [float(v) for v in s.split(",")]), help="list of possible angles for the tiles")
     parser.add_argument("--verbose", default=False, const=True, action="store_const", help="display more verbose info messages")
-    parser.add_argument("--sampling", default=None, type=int, action="store", help="select a sample of the library (random)")
+    parser.add_argument("--sampling", default=None, type=int, action="store", help="select a random sample of distinct tiles of the library")
     parser.add_argument("--stripes", default=None, type=(lambda s: map(int, s.split(','))), action="store", help="optionally add stripes, option values is (width, step)")
     parser.add_argument("--min-alpha-tile", default=0, type=float, action="store", help="minimum alpha value for lib tile during composition")
     parser.add_argument("--max-alpha-tile", default=1.0, type=float, action="store", help="maximum alpha value for lib tile during composition")
+    parser.add_argument("--pyramid-size", default=128, type=int, action="store", help="size of the canonical (square) thumbnails from which smaller tile sizes are derived (0: disabled)")
+    parser.add_argument("--dedup", default=False, const=True, action="store_const", help="prune near-duplicate library images (only one image of each cluster of near-duplicates is kept)")
+    parser.add_argument("--dedup-distance", default=6, type=int, action="store", help="maximal Hamming distance (bits out of 64, up to 7 for fast lookups) between the perceptual hashes of near-duplicate images")
+    parser.add_argument("--jobs", default=None, type=int, action="store", help="number of worker processes (library, closest tile selection) or threads (video rendering), default: one per cpu")
+    parser.add_argument("--perf-report", default=None, type=str, action="store", help="export the performance report (spans, counters, peak memory) to a .json or .csv file")
+    parser.add_argument("--perf-hook", default=None, type=str, choices=["cprofile", "tracemalloc"], help="profile the run with cProfile or tracemalloc (results are added to the performance report)")
+    parser.add_argument("--seed", default=None, type=int, action="store", help="random seed, for reproducible outputs")
 
     subParsers = parser.add_subparsers()
     def cmdLineVideoGen(args, cfg, source, tiles):
         frameW, frameH = args.size
-        videoCfg = VideoConfiguration(args.num_frames, args.extra_frames, args.alpha_gen)
+        videoCfg = VideoConfiguration(args.num_frames, args.extra_frames, args.alpha_gen, args.renderer)
         generateVideo(cfg, videoCfg, source, tiles, frameW, frameH,
                       videoFileName=args.output)
     videoCmdParser = subParsers.add_parser('video', help='generate video output')
@@ -465,6 +2271,7 @@ if __name__ == "__main__":
     videoCmdParser.add_argument("--extra-frames", default=250,  type=int, help="number of extra (still) frames")
     videoCmdParser.add_argument("--output", default="mosaic-video.avi",  type=str, help="filename for the output video")
     videoCmdParser.add_argument("--alpha-gen", default="random",  type=str, choices=AlphaGenerator.generators.keys(), help="filename for the output video")
+    videoCmdParser.add_argument("--renderer", default="incremental",  type=str, choices=FrameRenderer.renderers.keys(), help="frame rendering method: incremental (only tiles whose alpha changed are recomposed) or parallel (every frame is composed by a pool of threads)")
     videoCmdParser.set_defaults(func=cmdLineVideoGen)
 
     def cmdLineSingleImgGen(args, cfg, source, tiles):
@@ -472,15 +2279,78 @@ if __name__ == "__main__":
         cv2.imwrite(args.output, dest)
     imageCmdParser = subParsers.add_parser('image', help="generate image output")
     imageCmdParser.add_argument('--output', default="mosaic.png", type=str, help='path to destination image')
+    imageCmdParser.add_argument('--stream', default=False, const=True, action="store_const", help="process source (.ppm or .npy, memory-mapped) and output (.ppm or .npy) by bands of tile rows, for sources which do not fit in memory")
+    imageCmdParser.add_argument('--band-rows', default=16, type=int, help="number of tile rows per band in --stream mode")
     imageCmdParser.set_defaults(func=cmdLineSingleImgGen)
 
+    def cmdLineBatch(args, cfg, service):
+        jobs = []
+        if args.job_file:
+            with open(args.job_file) as stream:
+                jobs += [json.loads(line) for line in stream if line.strip()]
+        for sourceFilename in args.sources:
+            stem = os.path.splitext(os.path.basename(sourceFilename))[0]
+            jobs.append({"source": sourceFilename, "output": args.output_pattern.format(stem=stem), "mode": args.mode})
+        run_batch(service, jobs)
+    batchCmdParser = subParsers.add_parser('batch', help="generate the mosaics of a list of sources/jobs with a single library load")
+    batchCmdParser.add_argument('sources', nargs="*", type=str, help="source images")
+    batchCmdParser.add_argument('--job-file', default=None, type=str, help="json lines file of jobs ({\"source\": ..., \"output\": ..., \"mode\": \"image\" or \"video\", ...})")
+    batchCmdParser.add_argument('--output-pattern', default="{stem}_mosaic.png", type=str, help="output filename pattern of sources ({stem} is the source filename without extension)")
+    batchCmdParser.add_argument('--mode', default="image", type=str, choices=["image", "video"], help="output mode of sources")
+    batchCmdParser.set_defaults(service_func=cmdLineBatch)
+
+    def cmdLineServe(args, cfg, service):
+        serve(service, args.host, args.port)
+    serveCmdParser = subParsers.add_parser('serve', help="serve mosaic jobs (json POST requests) over local HTTP with a resident library")
+    serveCmdParser.add_argument('--host', default="127.0.0.1", type=str, help="listening address")
+    serveCmdParser.add_argument('--port', default=8765, type=int, help="listening port")
+    serveCmdParser.set_defaults(service_func=cmdLineServe)
+
     args = parser.parse_args()
+    if args.seed is not None:
+        # every random choice (tile selection, library sampling, alpha generators)
+        # derives from the random module state
+        random.seed(args.seed)
 
 
     cfg = Configuration(args.tile_size,
                         args.library, args.tile_dir,
-                        args.min_alpha_tile, args.max_alpha_tile)
-    source = Source(args.source)
+                        args.min_alpha_tile, args.max_alpha_tile, args.jobs,
+                        args.source_coeff, args.mosaic_coeff,
+                        args.assignment, args.reuse, args.pyramid_size,
+                        args.dedup_distance if args.dedup else None)
+
+    def reportPerf():
+        if args.perf_hook:
+            PerfMetric.stopHook()
+        for metric in PerfMetric.spans():
+            print(metric.summary())
+        for name, value in PerfMetric.counters.items():
+            print(f"{name:30} {value}")
+        selfRSS, childrenRSS = peak_rss()
+        if selfRSS is not None:
+            print(f"peak RSS {selfRSS} kB (worker processes: {childrenRSS} kB)")
+        if args.perf_report:
+            PerfMetric.exportReport(args.perf_report)
+            print(f"performance report exported to {args.perf_report}")
+
+    if args.perf_hook:
+        PerfMetric.startHook(args.perf_hook)
+
+    if getattr(args, "service_func", None):
+        # batch and server modes: the library is loaded once for every job
+        print("loading image from library")
+        if args.library:
+            image_library = build_image_library(cfg, args.metric, args.tile_angles, args.verbose, args.sampling)
+        else:
+            image_library = load_pixel_library(cfg, args.metric, args.tile_angles, args.verbose, args.sampling)
+        service = MosaicService(cfg, args.metric, image_library, args.random_size, args.fast, args.index)
+        args.service_func(args, cfg, service)
+        reportPerf()
+        sys.exit(0)
+
+    streamed = getattr(args, "stream", False)
+    source = Source(args.source, mmap=streamed)
 
     print("building destination image of size {} x {}".format(source.width, source.height))
 
@@ -495,24 +2365,31 @@ if __name__ == "__main__":
     if args.library:
         image_library = build_image_library(cfg, args.metric, args.tile_angles, args.verbose, args.sampling)
     else:
-        image_library = load_pixel_library(args.tile_dir, args.metric, args.tile_angles, args.verbose, args.sampling)
+        image_library = load_pixel_library(cfg, args.metric, args.tile_angles, args.verbose, args.sampling)
     genLibMetric.stop()
 
 
-    print("building map of closest library tile for each source tile")
-    genTilesMetric.start()
-    tiles = buildMosaicTiles(source, args.metric, image_library, args.random_size, args.fast)
-    genTilesMetric.stop()
+    if streamed:
+        # closest tile selection and output generation are interleaved
+        print("generating streamed mosaic image")
+        genMosaicMetric.start()
+        generateStreamedImage(cfg, source, args.metric, image_library, args.output, args.random_size,
+                              args.fast, args.index, args.stripes, args.band_rows)
+        genMosaicMetric.stop()
+    else:
+        print("building map of closest library tile for each source tile")
+        genTilesMetric.start()
+        tiles = buildMosaicTiles(source, args.metric, image_library, args.random_size, args.fast, args.index)
+        genTilesMetric.stop()
 
 
-    print("generating mosaic image/video")
-    genMosaicMetric.start()
-    args.func(args, cfg, source, tiles)
-    genMosaicMetric.stop()
+        print("generating mosaic image/video")
+        genMosaicMetric.start()
+        args.func(args, cfg, source, tiles)
+        genMosaicMetric.stop()
 
 
-    for metric in PerfMetric.metricList:
-        print(metric.summary())
+    reportPerf()
 
 
 
@@ -0,0 +1,33 @@
+""" closest tile selection tests """
+import random
+
+import numpy as np
+import pytest
+
+import main
+
+
+def tied_library(numMetrics=100, copies=40, seed=0):
+    """ library in which each metric is shared by <copies> tiles """
+    rng = np.random.default_rng(seed)
+    return np.repeat(rng.integers(0, 256, (numMetrics, 3)).astype(np.float32), copies, axis=0)
+
+def select(matcher, srcMetrics, seed=1):
+    random.seed(seed)
+    return matcher.match(srcMetrics)
+
+@pytest.mark.parametrize("chunkSize", [7, 64])
+def test_serial_selection_independent_of_chunk_size(chunkSize):
+    libMetrics = tied_library()
+    srcMetrics = np.random.default_rng(1).integers(0, 256, (1500, 3)).astype(np.float32)
+    reference = select(main.ExactMatcher(libMetrics, chunkSize=256), srcMetrics)
+    assert np.array_equal(select(main.ExactMatcher(libMetrics, chunkSize=chunkSize), srcMetrics), reference)
+
+@pytest.mark.parametrize("jobs", [2, 3])
+def test_parallel_selection_identical_to_serial_on_tied_library(jobs):
+    libMetrics = tied_library()
+    srcMetrics = np.random.default_rng(1).integers(0, 256, (1500, 3)).astype(np.float32)
+    reference = select(main.ExactMatcher(libMetrics), srcMetrics)
+    selected = select(main.ParallelMatcher(libMetrics, chunkSize=64, jobs=jobs), srcMetrics)
+    assert np.array_equal(selected, reference)
+    assert len(np.unique(selected)) == len(selected)
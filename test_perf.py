@@ -0,0 +1,32 @@
+""" performance report tests """
+import threading
+import time
+
+import main
+
+
+def test_span_shared_by_concurrent_threads():
+    # overlapping jobs of several threads use the same top-level span, each
+    # thread starting it 30ms after the previous one
+    numThreads = 4
+    metric = main.PerfMetric("concurrent span")
+    started = [threading.Event() for _ in range(numThreads + 1)]
+    started[0].set()
+    barrier = threading.Barrier(numThreads)
+    def job(index):
+        started[index].wait()
+        metric.start()
+        time.sleep(0.03)
+        started[index + 1].set()
+        barrier.wait()
+        time.sleep(0.05)
+        metric.stop(1)
+    threads = [threading.Thread(target=job, args=(index,)) for index in range(numThreads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert metric.calls == numThreads and metric.count == numThreads
+    # each thread accounts for its own duration
+    assert metric.elapsed >= sum(0.03 * (numThreads - 1 - index) + 0.05 for index in range(numThreads))
+    assert not metric.startTS